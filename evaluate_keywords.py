@@ -0,0 +1,184 @@
+# Benchmark for the naive bayes keyword model.
+# Runs stratified cross-validation for many products in parallel and writes
+# per-product precision, recall and timings to a csv or json report.
+#
+# ex: python evaluate_keywords.py --n-products 2000 --seed 42 --output report.csv
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from multiprocessing import Pool
+from random import Random
+from time import time
+import csv
+import json
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold
+
+from keyword_extraction import vectorize_reviews, title_stop_words
+from nb_scorer import nb_log_probs
+
+# Columns of the report, in order
+REPORT_FIELDS = ["asin", "n_positive", "n_negative", "precision", "recall",
+                 "seconds", "error"]
+
+
+def evaluate_product(task):
+    """Cross-validate the keyword model on one product's reviews.
+
+    task is an (asin, title, [(score, review text), ...], n_folds, seed) tuple.
+    The reviews are vectorized once and every fold is scored from slices of the
+    same count matrix. Precision and recall are for the positive class,
+    averaged over the folds.
+    """
+
+    asin, title, scored_reviews, n_folds, seed = task
+
+    start_time = time()
+
+    reviews = [review for score, review in scored_reviews if score != 3]
+    positive = np.array([score > 3 for score, _ in scored_reviews if score != 3])
+
+    result = {"asin": asin,
+              "n_positive": int(positive.sum()),
+              "n_negative": int((~positive).sum()),
+              "precision": None,
+              "recall": None,
+              "error": None}
+
+    if min(result["n_positive"], result["n_negative"]) < n_folds:
+        result["error"] = "fewer than {} reviews in a class".format(n_folds)
+        result["seconds"] = time() - start_time
+        return result
+
+    _, X = vectorize_reviews(reviews, title_stop_words(title))
+    X = X.tocsr()
+
+    skf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+
+    precision = []
+    recall = []
+
+    for train, test in skf.split(X, positive):
+
+        train_positive = positive[train]
+
+        # Fit naive bayes from the class word counts of the training rows
+        pos_counts = np.asarray(X[train[train_positive]].sum(axis=0)).ravel()
+        neg_counts = np.asarray(X[train[~train_positive]].sum(axis=0)).ravel()
+        pos_log_prob, neg_log_prob = nb_log_probs(pos_counts, neg_counts)
+
+        # Class priors, like MultinomialNB(fit_prior=True)
+        pos_prior = np.log(train_positive.mean())
+        neg_prior = np.log(1 - train_positive.mean())
+
+        # Predict on the test rows. Ties go to negative, like MultinomialNB.
+        X_test = X[test]
+        y_hat = X_test.dot(pos_log_prob) + pos_prior > X_test.dot(neg_log_prob) + neg_prior
+        y_test = positive[test]
+
+        true_positives = float((y_hat & y_test).sum())
+
+        precision.append(true_positives / y_hat.sum() if y_hat.any() else 0.0)
+        recall.append(true_positives / y_test.sum())
+
+    result["precision"] = float(sum(precision) / len(precision))
+    result["recall"] = float(sum(recall) / len(recall))
+    result["seconds"] = time() - start_time
+
+    return result
+
+
+def write_report(filename, results, settings):
+    """Write results to a .json file with a summary, or to a .csv file"""
+
+    if filename.endswith(".json"):
+        with open(filename, "w") as f:
+            json.dump({"settings": settings,
+                       "summary": summarize(results),
+                       "products": results}, f, indent=2)
+    else:
+        with open(filename, "wb") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def summarize(results):
+    """Average precision and recall over the products that could be evaluated"""
+
+    evaluated = [r for r in results if r["error"] is None]
+    n = float(len(evaluated)) or 1.0
+
+    return {"n_products": len(results),
+            "n_evaluated": len(evaluated),
+            "precision": sum(r["precision"] for r in evaluated) / n,
+            "recall": sum(r["recall"] for r in evaluated) / n,
+            "seconds": sum(r["seconds"] for r in results)}
+
+
+def main():
+    """Parse command line arguments and run the benchmark"""
+
+    parser = ArgumentParser(description="Cross-validate the keyword model")
+    parser.add_argument("--n-products", type=int, default=50,
+                        help="number of products to sample")
+    parser.add_argument("--min-reviews", type=int, default=20,
+                        help="only sample products with more reviews than this")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes (default: number of cpus)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the product sample and the folds")
+    parser.add_argument("--output", default="keyword_report.csv",
+                        help="report file, .csv or .json")
+    args = parser.parse_args()
+
+    from model import Product, Review, connect_to_db, db
+    from server import app
+
+    # Connect to the db
+    connect_to_db(app)
+
+    products = db.session.query(Product.asin, Product.title).filter(
+        Product.n_scores > args.min_reviews).order_by(Product.asin).all()
+
+    # The same seed always picks the same products
+    products = Random(args.seed).sample(products, min(args.n_products, len(products)))
+    titles = dict(products)
+
+    print "Evaluating {} products".format(len(products))
+
+    # Fetch the reviews of every sampled product in one query
+    reviews = defaultdict(list)
+
+    for asin, score, review in db.session.query(Review.asin, Review.score, Review.review).filter(
+            Review.asin.in_(titles.keys())):
+        reviews[asin].append((score, review))
+
+    tasks = [(asin, titles[asin], reviews[asin], args.folds, args.seed)
+             for asin, _ in products]
+
+    start_time = time()
+
+    pool = Pool(args.workers)
+    results = pool.map(evaluate_product, tasks, chunksize=1)
+    pool.close()
+    pool.join()
+
+    settings = vars(args)
+    settings["wall_seconds"] = time() - start_time
+
+    write_report(args.output, results, settings)
+
+    summary = summarize(results)
+
+    print "Evaluated {} of {} products in {:.1f} seconds".format(
+        summary["n_evaluated"], summary["n_products"], settings["wall_seconds"])
+    print "Average precision: {}".format(summary["precision"])
+    print "Average recall: {}".format(summary["recall"])
+    print "Report written to {}".format(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Cache of each user's favorite product asins and review ids"""
+
+from collections import namedtuple
+
+from flask import g, has_app_context
+
+from model import User
+from query_cache import QueryCache
+
+# Sets of the asins and review ids a user has favorited
+FavoriteIds = namedtuple('FavoriteIds', ['asins', 'review_ids'])
+
+# user_id -> FavoriteIds. The ttl is short because only this process knows
+# when a toggle happens, so other processes can be stale for up to ttl seconds.
+favorites_cache = QueryCache(max_size=5000, ttl=30)
+
+
+def get_favorite_ids(user_id):
+    """Return the FavoriteIds of a user.
+
+       Memoized for the current request on flask.g, and cached across
+       requests in favorites_cache, so a page that checks favorites in
+       several places runs at most one query.
+    """
+
+    memo = None
+
+    if has_app_context():
+        memo = g.setdefault('favorite_ids', {})
+
+        if user_id in memo:
+            return memo[user_id]
+
+    favorite_ids = favorites_cache.get_or_compute(
+        user_id, lambda: FavoriteIds(*User.fetch_favorite_ids(user_id)))
+
+    if memo is not None:
+        memo[user_id] = favorite_ids
+
+    return favorite_ids
+
+
+def invalidate(user_id):
+    """Forget a user's favorites after they favorite or unfavorite something"""
+
+    favorites_cache.invalidate(lambda key: key == user_id)
+
+    if has_app_context():
+        g.setdefault('favorite_ids', {}).pop(user_id, None)
+
+
+def get_cache_stats():
+    """Return hit/miss counters for the favorites cache"""
+
+    return favorites_cache.stats()
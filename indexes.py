@@ -0,0 +1,249 @@
+## Creates the indexes declared on the models without locking their tables,
+## and checks that the queries behind the main routes use them.
+##
+## ex: python indexes.py          (create missing indexes, then check plans)
+
+import json
+import re
+import sys
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from model import User, Product, Review, ProductSummary, Category, connect_to_db, db
+from search_query import make_search_filters
+
+# Tables big enough that a sequential scan in a route is a bug
+LARGE_TABLES = ('products', 'reviews', 'favorite_products', 'favorite_reviews',
+                'product_categories', 'product_summaries')
+
+def declared_indexes():
+    """Return every index declared on the models, ordered by table"""
+
+    return [index
+            for table in db.metadata.sorted_tables
+            for index in sorted(table.indexes, key=lambda i: i.name)]
+
+
+def create_index_sql(index):
+    """Return CREATE INDEX CONCURRENTLY IF NOT EXISTS sql for an Index"""
+
+    sql = unicode(CreateIndex(index).compile(dialect=db.engine.dialect))
+
+    return re.sub(r'^CREATE (UNIQUE )?INDEX ',
+                  r'CREATE \1INDEX CONCURRENTLY IF NOT EXISTS ',
+                  sql)
+
+
+def create_indexes_concurrently():
+    """Build any declared index that the db is missing.
+
+       CONCURRENTLY keeps the tables writable while the indexes are built, but
+       can't run inside a transaction, so each statement autocommits. An
+       interrupted concurrent build leaves an invalid index behind, which is
+       dropped first so that it gets rebuilt.
+    """
+
+    # Don't hold locks from the session while the indexes are built
+    db.session.commit()
+
+    conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+    try:
+        invalid = conn.execute("""SELECT c.relname
+                                  FROM pg_index i
+                                  JOIN pg_class c ON c.oid = i.indexrelid
+                                  WHERE NOT i.indisvalid;
+                               """).fetchall()
+        invalid = set(name for name, in invalid)
+
+        for index in declared_indexes():
+
+            if index.name in invalid:
+                print "Dropping invalid index {}".format(index.name)
+                conn.execute("DROP INDEX CONCURRENTLY IF EXISTS {};".format(index.name))
+
+            print "Creating index {}".format(index.name)
+            conn.execute(create_index_sql(index))
+    finally:
+        conn.close()
+
+
+def drop_indexes():
+    """Drop the declared indexes, so a bulk load doesn't update them row by row.
+
+       Rebuild them afterwards with create_indexes_concurrently().
+    """
+
+    for index in declared_indexes():
+        db.session.execute("DROP INDEX IF EXISTS {};".format(index.name))
+
+    db.session.commit()
+
+
+def explain(sql, params):
+    """Return the plan postgres picks for a query, as a dictionary"""
+
+    result = db.session.execute("EXPLAIN (FORMAT JSON) " + sql, params).scalar()
+
+    # psycopg2 returns the json plan as text
+    if isinstance(result, basestring):
+        result = json.loads(result)
+
+    return result[0]["Plan"]
+
+
+def find_seq_scans(plan, tables=LARGE_TABLES):
+    """Return the names of the tables in a plan that are read by sequential scan"""
+
+    scanned = []
+
+    if plan["Node Type"] == "Seq Scan" and plan.get("Relation Name") in tables:
+        scanned.append(plan["Relation Name"])
+
+    for subplan in plan.get("Plans", []):
+        scanned.extend(find_seq_scans(subplan, tables))
+
+    return scanned
+
+
+def compile_query(query):
+    """Return the (sql, params) of an ORM Query.
+
+       The sql uses :name parameters, like the sql the models write by hand,
+       so both kinds of query can be passed to explain().
+    """
+
+    compiled = query.statement.compile(dialect=postgresql.dialect(paramstyle='named'))
+
+    return unicode(compiled), compiled.params
+
+
+def sample_params():
+    """Pick a review, its product, a user, a category and a search term that
+       exist in the db
+    """
+
+    asin, review_id, time, title, price = db.session.execute("""
+        SELECT r.asin, r.review_id, r.time, p.title, p.price
+        FROM reviews r JOIN products p USING (asin)
+        LIMIT 1;
+    """).first()
+
+    user_id = db.session.execute("SELECT user_id FROM users LIMIT 1;").scalar()
+    cat_id = db.session.execute("SELECT cat_id FROM categories LIMIT 1;").scalar()
+
+    return {"asin": asin,
+            "review_id": review_id,
+            "time": time,
+            "price": price,
+            "user_id": user_id,
+            "cat_id": cat_id,
+            "query": title.split()[-1]}
+
+
+def route_queries(params):
+    """Return (name, sql, params) of the queries the main routes run.
+
+       The sql comes from the same builders the routes call, so the plans
+       are the plans of the real queries. params is from sample_params().
+    """
+
+    from server import SEARCH_PAGE_SIZE, REVIEW_PAGE_SIZE
+
+    query = params["query"]
+    asin = params["asin"]
+    user_id = params["user_id"]
+
+    # The routes fetch one extra row to know if there's a next page
+    page_size = SEARCH_PAGE_SIZE + 1
+    in_category = make_search_filters(cat_ids=[params["cat_id"]])
+
+    queries = [
+        ("product search",
+         Product.build_search_query(query, page_size)),
+        ("product search by score",
+         Product.build_search_query(query, page_size, sort="pg_score")),
+        ("product search by price",
+         Product.build_search_query(query, page_size, sort="price")),
+        ("next page of product search",
+         Product.build_search_query(query, page_size, sort="price",
+                                    cursor=(params["price"], asin))),
+        ("product search in a category",
+         Product.build_search_query(query, page_size, filters=in_category)),
+        ("search category counts",
+         Product.build_category_count_query(query)),
+        ("review search",
+         Review.build_search_query(asin, query, REVIEW_PAGE_SIZE)),
+        ("product summary",
+         compile_query(ProductSummary.query.filter_by(asin=asin))),
+        ("more product reviews",
+         compile_query(Product.reviews_page_query(asin, REVIEW_PAGE_SIZE + 1,
+                                                  (params["time"],
+                                                   params["review_id"])))),
+        ("category",
+         compile_query(Category.query.filter_by(cat_id=params["cat_id"]))),
+        ("user favorites",
+         (User.FAVORITE_IDS_SQL, {"user_id": user_id})),
+        ("favorite a product",
+         (User.TOGGLE_FAVORITE_PRODUCT_SQL, {"user_id": user_id, "asin": asin})),
+        ("favorite a review",
+         (User.TOGGLE_FAVORITE_REVIEW_SQL, {"user_id": user_id,
+                                            "review_id": params["review_id"]})),
+    ]
+
+    # These are built from rows that the summaries and top products fill in
+    summary = ProductSummary.query.get(asin)
+
+    if summary is not None and summary.recent_review_ids:
+        queries.append(("product page reviews",
+                        compile_query(summary.recent_reviews_query())))
+
+    category = Category.query.get(params["cat_id"])
+
+    if category is not None and category.top_asins:
+        queries.append(("category top products",
+                        compile_query(category.top_products_query())))
+
+    return [(name, sql, sql_params) for name, (sql, sql_params) in queries]
+
+
+def check_route_queries(params=None, tables=LARGE_TABLES):
+    """EXPLAIN each of route_queries().
+
+       Returns a dictionary of query name -> tables read by sequential scan,
+       which is empty when every query uses an index.
+    """
+
+    if params is None:
+        params = sample_params()
+
+    failures = {}
+
+    for name, sql, sql_params in route_queries(params):
+        scanned = find_seq_scans(explain(sql, sql_params), tables)
+
+        if scanned:
+            failures[name] = scanned
+
+    return failures
+
+
+##################### Run script #################################
+
+if __name__ == "__main__":
+
+    from server import app
+    connect_to_db(app)
+
+    create_indexes_concurrently()
+
+    failures = check_route_queries()
+
+    for name, tables in sorted(failures.iteritems()):
+        print "Sequential scan in {}: {}".format(name, ", ".join(tables))
+
+    if failures:
+        sys.exit(1)
+
+    print "All route queries use indexes"
@@ -8,12 +8,33 @@ from sklearn.naive_bayes import MultinomialNB
 from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import confusion_matrix, precision_recall_fscore_support
 from sklearn.feature_extraction import text
-from random import sample
+from collections import namedtuple
+from nb_scorer import nb_keywords
 
 # Set of additional stop words to add to the builtin sklearn stop words
 PG_STOP_WORDS = ["great", "good", "bad", "awful", "excellent", "terrible",
                  "amazing", "worst", "perfect", "horrible", "best"]
 
+# Stop words shared by every product, built once for the catalog-wide mode
+CATALOG_STOP_WORDS = text.ENGLISH_STOP_WORDS.union(PG_STOP_WORDS)
+
+# Splits a review into words the same way as the vectorizers, minus the
+# catalog stop words
+analyze_review = CountVectorizer(stop_words=CATALOG_STOP_WORDS).build_analyzer()
+
+# Word counts for the reviews of the whole catalog.
+# X is a sparse matrix with one row per review and one column per word in
+# features. Reviews are grouped by product: rows maps asin -> (start, end).
+# positive is a boolean array that is True for the rows of positive reviews.
+ReviewMatrix = namedtuple('ReviewMatrix', ['X', 'positive', 'features',
+                                           'vocabulary', 'rows'])
+
+
+def title_stop_words(title):
+    """Return the lowercased words of a product's title to use as stop words"""
+
+    return [w.lower() for w in title.split(' ')]
+
 
 def get_keywords_from_naive_bayes(product, new_stop_words, validation=False):
     """Extracts positive/negative words from a product's reviews with Naive Bayes
@@ -25,66 +46,223 @@ def get_keywords_from_naive_bayes(product, new_stop_words, validation=False):
     review gavethe product 1 or 2 stars.
     """
 
+    reviews = [(rev.score, rev.review) for rev in product.reviews]
+
+    return get_keywords_from_reviews(reviews, new_stop_words, validation)
+
+
+def vectorize_reviews(reviews, new_stop_words):
+    """Count the words in a list of review texts.
+
+    Returns the fitted vectorizer and a sparse matrix of word counts where the
+    rows are reviews and the columns are words.
+    """
+
+    # Add any new stop words (e.g. the product name) to the set of default stop words
+    new_stop_words.extend(PG_STOP_WORDS)
+    stop_words = text.ENGLISH_STOP_WORDS.union(new_stop_words)
+
+    # Instantiate a count vectorizer
+    vectorizer = CountVectorizer(stop_words=stop_words)
+
+    return (vectorizer, vectorizer.fit_transform(reviews))
+
+
+def get_keywords_from_reviews(scored_reviews, new_stop_words, validation=False):
+    """Extracts positive/negative words from (score, review text) tuples.
+
+    This is get_keywords_from_naive_bayes() without the db access, so it can
+    run in a worker process.
+    """
+
     # list of labels for a review: positive or negative
     labels = []
 
     # list of reviews
     reviews = []
 
-    for rev in product.reviews:
+    for score, review in scored_reviews:
         # Iterate through a products reviews,
         # If the score is a 1 or 2, label it as negative
         # If the score is a 4 or 5, label it as positive
         # This algorithm throws out reviews with a score of 3
 
-        if rev.score < 3:
+        if score < 3:
             labels.append("negative")
-            reviews.append(rev.review)
+            reviews.append(review)
 
-        elif rev.score > 3:
+        elif score > 3:
             labels.append("positive")
-            reviews.append(rev.review)
+            reviews.append(review)
 
-    # Add any new stop words (e.g. the product name) to the set of default stop words
-    new_stop_words.extend(PG_STOP_WORDS)
-    stop_words = text.ENGLISH_STOP_WORDS.union(new_stop_words)
+    vectorizer, X = vectorize_reviews(reviews, new_stop_words)
+    y = np.array(labels)
 
-    # Instantiate a count vectorizer
-    vectorizer = CountVectorizer(stop_words=stop_words)
+    if validation:
+        # If validation argument set to true, run KFolds
+        nb = MultinomialNB()
+        precision, recall = cross_validate(nb, X, y)
+        return (precision, recall)
 
-    # Convert our list of reviews into a sparse matrix of word counts where the
-    # rows are reviews and the columns are words
-    X = vectorizer.fit_transform(reviews)
-    y = np.array(labels)
+    # Count each word in positive and negative reviews. This is all naive
+    # bayes needs to rank the keywords, so no model has to be fit.
+    positive = y == "positive"
+    pos_counts = np.asarray(X[positive].sum(axis=0)).ravel()
+    neg_counts = np.asarray(X[~positive].sum(axis=0)).ravel()
 
-    # Fit model
-    nb = MultinomialNB()
-    nb.fit(X, y)
+    # array of words
+    features = np.array(vectorizer.get_feature_names())
 
-    # probabilities for most negative words
-    pos_probs = nb.feature_log_prob_[1] - nb.feature_log_prob_[0]
+    # Return tuple of positive and negative keywords
+    return nb_keywords(pos_counts, neg_counts, features)
 
-    # probabilities for most positive words
-    neg_probs = nb.feature_log_prob_[0] - nb.feature_log_prob_[1]
 
-    # array of words
-    features = vectorizer.get_feature_names()
+def extract_keywords(task):
+    """Extract keywords for one product in a worker process.
 
-    # list of (probability, word) tuples sorted by log probabilities in descending order
-    pos_probs_and_words = sorted(zip(pos_probs, features), reverse=True)[:10]
-    neg_probs_and_words = sorted(zip(neg_probs, features), reverse=True)[:10]
+    task is an (asin, title, [(score, review text), ...]) tuple.
+    Returns an (asin, pos_words, neg_words) tuple. Products without both
+    positive and negative reviews get no keywords.
+    """
 
-    pos_words = [tup[1] for tup in pos_probs_and_words]
-    neg_words = [tup[1] for tup in neg_probs_and_words]
+    asin, title, scored_reviews = task
 
-    if validation:
-        # If validation argument set to true, run KFolds
-        precision, recall = cross_validate(nb, X, y)
-        return (precision, recall)
+    has_positive = any(score > 3 for score, _ in scored_reviews)
+    has_negative = any(score < 3 for score, _ in scored_reviews)
+
+    if not (has_positive and has_negative):
+        return (asin, [], [])
+
+    pos_words, neg_words = get_keywords_from_reviews(scored_reviews,
+                                                     title_stop_words(title))
+
+    return (asin, pos_words, neg_words)
+
+
+def build_review_matrix(reviews):
+    """Tokenize the whole review corpus once into a ReviewMatrix.
+
+    reviews is an iterable of (asin, score, review text) tuples sorted by asin.
+    Reviews with a score of 3 are thrown out, like in get_keywords_from_reviews().
+    """
+
+    asins = []
+    positive = []
+    texts = []
 
-    else:
-        # Return tuple of positive and negative keywords
-        return (pos_words, neg_words)
+    for asin, score, review in reviews:
+        if score != 3:
+            asins.append(asin)
+            positive.append(score > 3)
+            texts.append(review)
+
+    vectorizer = CountVectorizer(stop_words=CATALOG_STOP_WORDS)
+    X = vectorizer.fit_transform(texts).tocsr()
+
+    # Find the range of rows that belongs to each product
+    rows = {}
+    start = 0
+
+    for i in range(1, len(asins) + 1):
+        if i == len(asins) or asins[i] != asins[start]:
+            rows[asins[start]] = (start, i)
+            start = i
+
+    return ReviewMatrix(X=X,
+                        positive=np.array(positive, dtype=bool),
+                        features=np.array(vectorizer.get_feature_names()),
+                        vocabulary=vectorizer.vocabulary_,
+                        rows=rows)
+
+
+def get_catalog_keywords(matrix, titles, n_words=10):
+    """Yield (asin, pos_words, neg_words) for every product in a ReviewMatrix.
+
+    titles maps asin -> product title, and every product in it is yielded.
+    The results match get_keywords_from_naive_bayes(): each product's
+    vocabulary is the set of words used in its own reviews, minus the words
+    in its title, and naive bayes log ratios are computed from its word
+    counts per class.
+    """
+
+    for asin, (start, end) in matrix.rows.iteritems():
+
+        X = matrix.X[start:end]
+        positive = matrix.positive[start:end]
+
+        # Naive bayes needs reviews of both classes
+        if positive.all() or not positive.any():
+            yield (asin, [], [])
+            continue
+
+        pos_counts = np.asarray(X[positive].sum(axis=0)).ravel()
+        neg_counts = np.asarray(X[~positive].sum(axis=0)).ravel()
+
+        # Mask of the columns in this product's vocabulary
+        columns = (pos_counts + neg_counts) > 0
+
+        for word in title_stop_words(titles[asin]):
+            column = matrix.vocabulary.get(word)
+            if column is not None:
+                columns[column] = False
+
+        pos_words, neg_words = nb_keywords(pos_counts[columns],
+                                           neg_counts[columns],
+                                           matrix.features[columns],
+                                           n_words)
+
+        yield (asin, pos_words, neg_words)
+
+    # Products without any 1, 2, 4 or 5 star reviews aren't in the matrix
+    for asin in sorted(set(titles) - set(matrix.rows)):
+        yield (asin, [], [])
+
+
+def count_review_words(reviews):
+    """Count words per product and class for incremental keyword updates.
+
+    reviews is an iterable of (asin, score, review text) tuples.
+    Returns a dictionary of (asin, word) -> [positive count, negative count].
+    Reviews with a score of 3 are thrown out.
+    """
+
+    counts = {}
+
+    for asin, score, review in reviews:
+        if score == 3:
+            continue
+
+        # Index into [positive count, negative count]
+        label = 0 if score > 3 else 1
+
+        for word in analyze_review(review):
+            counts.setdefault((asin, word), [0, 0])[label] += 1
+
+    return counts
+
+
+def get_keywords_from_counts(word_counts, title, n_words=10):
+    """Return (pos_words, neg_words) from a product's stored word counts.
+
+    word_counts is a list of (word, positive count, negative count) tuples.
+    Gives the same keywords as get_keywords_from_naive_bayes() on the reviews
+    the counts were built from.
+    """
+
+    title_words = set(title_stop_words(title))
+    word_counts = [wc for wc in word_counts
+                   if wc[0] not in title_words and (wc[1] or wc[2])]
+
+    pos_counts = np.array([wc[1] for wc in word_counts])
+    neg_counts = np.array([wc[2] for wc in word_counts])
+
+    # Naive bayes needs reviews of both classes
+    if not pos_counts.any() or not neg_counts.any():
+        return ([], [])
+
+    features = np.array([wc[0] for wc in word_counts])
+
+    return nb_keywords(pos_counts, neg_counts, features, n_words)
 
 
 def cross_validate(nb, X, y):
@@ -120,8 +298,8 @@ def cross_validate(nb, X, y):
             precision.append(p[1])
             recall.append(r[1])
 
-        avg_precision = sum(precision)/float(len(precision))
-        avg_recall = sum(recall)/float(len(recall))
+    avg_precision = sum(precision)/float(len(precision))
+    avg_recall = sum(recall)/float(len(recall))
 
     return (avg_precision, avg_recall)
 
@@ -129,45 +307,6 @@ def cross_validate(nb, X, y):
 
 if __name__ == "__main__":
 
-    # Run cross validation on 50 of the products and average the data
-
-    from model import Product, connect_to_db
-    from server import app
-
-    # Connect to the db
-    connect_to_db(app)
-
-    # Get all products with at least 20 reviews
-    products = Product.query.filter(Product.n_scores > 20).all()
-
-    print len(products)
-
-    # Create a list of 100 product indexes to run cross-validation on
-    validation_set = sample(range(0, len(products) - 1), 50)
-
-    # List to hold precision and recall
-    precision = []
-    recall = []
-
-    for idx in validation_set:
-        product = products[idx]
-
-        print "Validating product"
-
-        # Include the product's name as stop words
-        more_stop_words = product.title.split(' ')
-        more_stop_words = [w.lower() for w in more_stop_words]
-
-        p, r = get_keywords_from_naive_bayes(product,
-                                             more_stop_words,
-                                             True)
-        precision.append(p)
-        recall.append(r)
-
-    print precision
-    print "Average precision over 50 products is: {}".format(
-        sum(precision)/float(len(precision)))
-
-    print recall
-    print "Average recall over 50 products is: {}".format(
-        sum(recall)/float(len(recall)))
+    # Cross validation over many products lives in evaluate_keywords.py
+    from evaluate_keywords import main
+    main()
@@ -0,0 +1,148 @@
+"""Keeps product keywords up to date as new reviews arrive.
+
+   Per-product word counts for positive and negative reviews are stored in
+   product_word_counts. New reviews are folded into the counts, and only the
+   keywords of the products they belong to are recomputed.
+"""
+
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import insert
+
+from model import db, Product, Review, ProductWordCount, ProductSummary
+from keyword_extraction import count_review_words, get_keywords_from_counts
+
+# Number of reviews counted per transaction
+FOLD_BATCH_SIZE = 10000
+
+# Number of products whose keywords are recomputed per query
+REFRESH_BATCH_SIZE = 500
+
+# Number of (asin, word) counts upserted per statement
+WORD_COUNT_BATCH_SIZE = 5000
+
+
+def save_keywords(keywords):
+    """Write a list of (asin, pos_words, neg_words) tuples in one transaction.
+
+       The summaries of those products are refreshed afterwards.
+    """
+
+    update_keywords = Product.__table__.update().where(
+        Product.asin == bindparam('product_asin')).values(
+        pos_words=bindparam('pos_words'),
+        neg_words=bindparam('neg_words'))
+
+    db.session.execute(update_keywords,
+                       [{'product_asin': asin,
+                         'pos_words': pos_words,
+                         'neg_words': neg_words}
+                        for asin, pos_words, neg_words in keywords])
+    db.session.commit()
+
+    ProductSummary.refresh([asin for asin, _, _ in keywords])
+
+
+def add_word_counts(reviews):
+    """Add the words of (asin, score, review text) tuples to the stored counts.
+
+       Returns the set of asins whose counts changed.
+    """
+
+    counts = count_review_words(reviews)
+
+    if not counts:
+        return set()
+
+    rows = [{'asin': asin,
+             'word': word,
+             'pos_count': pos_count,
+             'neg_count': neg_count}
+            for (asin, word), (pos_count, neg_count) in counts.iteritems()]
+
+    table = ProductWordCount.__table__
+
+    # One multi-row INSERT ... ON CONFLICT per chunk, rather than a round
+    # trip per (asin, word)
+    for i in range(0, len(rows), WORD_COUNT_BATCH_SIZE):
+        upsert = insert(table).values(rows[i:i + WORD_COUNT_BATCH_SIZE])
+        upsert = upsert.on_conflict_do_update(
+            index_elements=['asin', 'word'],
+            set_={'pos_count': table.c.pos_count + upsert.excluded.pos_count,
+                  'neg_count': table.c.neg_count + upsert.excluded.neg_count})
+
+        db.session.execute(upsert)
+
+    db.session.commit()
+
+    return set(asin for asin, _ in counts)
+
+
+def refresh_keywords(asins):
+    """Recompute the top positive and negative keywords of the given products"""
+
+    asins = sorted(asins)
+
+    for i in range(0, len(asins), REFRESH_BATCH_SIZE):
+        batch = asins[i:i + REFRESH_BATCH_SIZE]
+
+        titles = dict(db.session.query(Product.asin, Product.title).filter(
+            Product.asin.in_(batch)))
+
+        word_counts = db.session.query(ProductWordCount.asin,
+                                       ProductWordCount.word,
+                                       ProductWordCount.pos_count,
+                                       ProductWordCount.neg_count).filter(
+            ProductWordCount.asin.in_(batch)).order_by(ProductWordCount.asin)
+
+        keywords = []
+
+        for asin, rows in groupby(word_counts, key=itemgetter(0)):
+            counts = [(word, pos, neg) for _, word, pos, neg in rows]
+            pos_words, neg_words = get_keywords_from_counts(counts, titles[asin])
+            keywords.append((asin, pos_words, neg_words))
+
+        if keywords:
+            save_keywords(keywords)
+
+
+def fold_in_reviews(after_review_id=0, refresh=True):
+    """Fold every review with an id greater than after_review_id into the counts.
+
+       Then recompute the keywords of the products those reviews belong to,
+       unless refresh is False. Returns the set of touched asins.
+    """
+
+    reviews = db.session.query(Review.review_id, Review.asin, Review.score, Review.review).filter(
+        Review.review_id > after_review_id,
+        Review.score != 3).order_by(Review.review_id)
+
+    touched = set()
+    last_review_id = after_review_id
+
+    while True:
+        # Page through the new reviews by id so memory stays bounded
+        batch = reviews.filter(Review.review_id > last_review_id).limit(FOLD_BATCH_SIZE).all()
+
+        if not batch:
+            break
+
+        last_review_id = batch[-1].review_id
+        touched |= add_word_counts((asin, score, review)
+                                   for _, asin, score, review in batch)
+
+    if refresh:
+        refresh_keywords(touched)
+
+    return touched
+
+
+def rebuild_word_counts(refresh=False):
+    """Recount every review from scratch"""
+
+    ProductWordCount.query.delete()
+    db.session.commit()
+
+    return fold_in_reviews(0, refresh=refresh)
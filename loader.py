@@ -0,0 +1,351 @@
+## Loads the amazon product and review files into the database.
+## seed.py runs these loaders when seeding, and migrations.py reloads
+## products from them.
+
+from model import db
+from model import Product, Review, ProductSummary, Category, product_categories
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime
+from time import time
+from ast import literal_eval
+from io import BytesIO
+from multiprocessing import Pool
+import json
+from HTMLParser import HTMLParser
+import keyword_stats
+import search_cache
+
+
+# Parser for the html entities in product and review text
+H = HTMLParser()
+
+# Number of products written to the db in each transaction
+PRODUCT_BATCH_SIZE = 1000
+
+# Number of reviews copied into the db in each transaction
+REVIEW_BATCH_SIZE = 50000
+
+
+##################### Loading helpers ###########################
+
+def parse_line(line):
+    """Parse one line of the amazon data files into a dictionary.
+
+       Most lines are python literals rather than strict json, so fall back
+       to literal_eval (never eval) when json can't parse them.
+    """
+
+    try:
+        return json.loads(line)
+    except ValueError:
+        return literal_eval(line)
+
+
+def iter_batches(items, batch_size):
+    """Yield lists of up to batch_size items from an iterable"""
+
+    batch = []
+
+    for item in items:
+        batch.append(item)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def report_progress(name, n_rows, start_time):
+    """Print the number of rows loaded so far and the throughput"""
+
+    elapsed = time() - start_time
+    rate = n_rows / elapsed if elapsed else 0
+
+    print "{} {} loaded ({:.0f} rows/sec)".format(n_rows, name, rate)
+
+
+##################### Load Products ###########################
+
+def get_category_paths():
+    """Return a dictionary of category path -> cat_id for the categories in the db.
+
+       A path is a tuple of category names from the root,
+       ex: ("Electronics", "Accessories", "Headphones")
+    """
+
+    categories = dict((cat_id, (cat_name, parent_id))
+                      for cat_id, cat_name, parent_id in db.session.query(
+                          Category.cat_id, Category.cat_name, Category.parent_id))
+
+    paths = {}
+
+    def get_path(cat_id):
+        if cat_id not in paths:
+            cat_name, parent_id = categories[cat_id]
+            parent_path = get_path(parent_id) if parent_id else ()
+            paths[cat_id] = parent_path + (cat_name,)
+        return paths[cat_id]
+
+    return dict((get_path(cat_id), cat_id) for cat_id in categories)
+
+
+def add_categories(new_paths, category_ids):
+    """Insert the categories for a set of new paths with one multi-row insert.
+
+       category_ids maps path -> cat_id and must already hold the parent of
+       every new path that isn't in new_paths. The new ids are added to it.
+    """
+
+    # Take ids from the sequence up front, so each row's materialized path
+    # can be written in the same insert as the row
+    new_ids = db.session.execute("""
+        SELECT nextval(pg_get_serial_sequence('categories', 'cat_id'))
+        FROM generate_series(1, :n);
+    """, {'n': len(new_paths)}).fetchall()
+
+    # Parents sort before their children
+    for path, (cat_id,) in zip(sorted(new_paths, key=len), new_ids):
+        category_ids[path] = cat_id
+
+    def id_path(path):
+        return '.'.join(str(category_ids[path[:i]]) for i in range(1, len(path) + 1))
+
+    rows = [{'cat_id': category_ids[path],
+             'cat_name': path[-1],
+             'parent_id': category_ids[path[:-1]] if len(path) > 1 else None,
+             'path': id_path(path)}
+            for path in new_paths]
+
+    db.session.execute(Category.__table__.insert().values(rows))
+
+
+def load_products(filename, batch_size=PRODUCT_BATCH_SIZE, commit=True):
+    """Load products from json-like file into database.
+
+       The file is streamed in batches. Each batch is written with one multi-row
+       insert per table in a single transaction, and category ids are kept in
+       memory so categories are never looked up per product.
+
+       Products already in the db get the file's title, description, price
+       and image, and keep their scores and keywords, so a file can be
+       loaded again, ex: to relink products along their category paths.
+       The summaries of each batch's products are refreshed to match.
+
+       Pass commit=False to load the whole file in the caller's transaction.
+       The caller then commits and refreshes the summaries.
+    """
+
+    print "=================="
+    print "loading products"
+
+    # Map of category path -> cat_id for the categories already in the db
+    category_ids = get_category_paths()
+
+    n_products = 0
+    start_time = time()
+
+    with open(filename) as f:
+        for batch in iter_batches(f, batch_size):
+
+            products = []
+            product_category_paths = []
+            new_paths = set()
+
+            for line in batch:
+                # Each line is a dictionary containing info on a product
+                p = parse_line(line)
+
+                # categories are stored in double brackets for weird semi-json reasons.
+                # The first list is the product's category path from the root.
+                # The product is linked to the category at every level of the path.
+                names = tuple(p['categories'][0])
+                paths = set(names[:i] for i in range(1, len(names) + 1))
+                new_paths.update(path for path in paths if path not in category_ids)
+                product_category_paths.append((p['asin'], paths))
+
+                title = p.get('title')
+                if title:
+                    title = H.unescape(title)
+
+                description = p.get('description')
+                if description:
+                    description = H.unescape(description)
+
+                products.append({'asin': p['asin'],
+                                 'title': title,
+                                 'description': description,
+                                 'price': p.get('price'),
+                                 'image': p.get('imUrl'),
+                                 'pos_words': [],
+                                 'neg_words': []})
+
+            if new_paths:
+                # Add the batch's new categories and remember their ids
+                add_categories(new_paths, category_ids)
+
+            links = [{'asin': asin, 'cat_id': category_ids[path]}
+                     for asin, paths in product_category_paths
+                     for path in paths]
+
+            upsert = insert(Product.__table__).values(products)
+            db.session.execute(upsert.on_conflict_do_update(
+                index_elements=['asin'],
+                set_={'title': upsert.excluded.title,
+                      'description': upsert.excluded.description,
+                      'price': upsert.excluded.price,
+                      'image': upsert.excluded.image}))
+
+            if links:
+                db.session.execute(insert(product_categories).values(links)
+                                   .on_conflict_do_nothing())
+
+            if commit:
+                db.session.commit()
+
+                # Product and category pages show the summaries
+                ProductSummary.refresh([product['asin'] for product in products])
+
+            n_products += len(products)
+            report_progress("products", n_products, start_time)
+
+    # Cached searches may be missing the new products
+    search_cache.invalidate_products()
+
+
+##################### Load Reviews ###########################
+
+def copy_value(value):
+    """Format a value for postgres' COPY text format"""
+
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+
+    return (value.replace('\\', '\\\\')
+                 .replace('\t', '\\t')
+                 .replace('\n', '\\n')
+                 .replace('\r', '\\r'))
+
+
+def parse_review_line(line):
+    """Parse a line of the reviews file into a row for COPY.
+
+       Runs in the worker processes of load_reviews, so it returns the
+       finished utf-8 encoded row.
+    """
+
+    r = parse_line(line)
+
+    review_time = datetime.strptime(r['reviewTime'], '%m %d, %Y')
+
+    values = [H.unescape(r['reviewText']),
+              r['asin'],
+              int(r['overall']),
+              H.unescape(r['summary']),
+              review_time.isoformat()]
+
+    return u'\t'.join(copy_value(v) for v in values).encode('utf-8')
+
+
+def copy_reviews(rows):
+    """Stream a list of COPY-formatted review rows into the reviews table"""
+
+    data = BytesIO('\n'.join(rows) + '\n')
+
+    # COPY goes through the session's connection so it's part of the
+    # session's transaction
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert("""COPY reviews (review, asin, score, summary, time)
+                          FROM STDIN""", data)
+
+    db.session.commit()
+
+
+def load_reviews(filename, batch_size=REVIEW_BATCH_SIZE, n_workers=None,
+                 update_keywords=False, rescore=True):
+    """Load reviews from json-like file into database.
+
+       Lines are parsed by a pool of n_workers processes (defaults to the
+       number of cpus) while the previous batch is copied into postgres, so
+       only two batches are held in memory at a time.
+
+       The products of the new reviews are rescored, which also refreshes
+       their summaries. Pass rescore=False when every product is rescored
+       afterwards anyway. If update_keywords is True, the new reviews are
+       folded into the stored word counts and the keywords of their products
+       are recomputed.
+    """
+
+    print "=================="
+    print "loading reviews"
+
+    last_review_id = db.session.query(db.func.max(Review.review_id)).scalar() or 0
+
+    pool = Pool(n_workers)
+
+    n_reviews = 0
+    start_time = time()
+
+    with open(filename) as f:
+        pending = None
+
+        for lines in iter_batches(f, batch_size):
+            # Each line is a review for one product in the products table
+            parsed = pool.map_async(parse_review_line, lines, chunksize=1000)
+
+            if pending:
+                rows = pending.get()
+                copy_reviews(rows)
+                n_reviews += len(rows)
+                report_progress("reviews", n_reviews, start_time)
+
+            pending = parsed
+
+        if pending:
+            rows = pending.get()
+            copy_reviews(rows)
+            n_reviews += len(rows)
+            report_progress("reviews", n_reviews, start_time)
+
+    pool.close()
+    pool.join()
+
+    if rescore:
+        # Histograms, scores and recent reviews of these products are stale
+        new_asins = [asin for asin, in db.session.execute("""
+            SELECT DISTINCT asin FROM reviews WHERE review_id > :last_review_id;
+        """, {'last_review_id': last_review_id})]
+
+        if new_asins:
+            count_scores(new_asins)
+
+    if update_keywords:
+        keyword_stats.fold_in_reviews(last_review_id)
+
+    # Cached review searches may be missing the new reviews
+    search_cache.invalidate_reviews()
+
+
+def count_scores(asins=None):
+    """Calculate score distribution, pg-score and update product object in db.
+
+       Rescores every product, or only the products in a list of asins.
+    """
+
+    print "======================"
+    print "calculating review distributions"
+
+    start_time = time()
+
+    Product.recompute_scores(asins)
+
+    print "rescored products in {:.1f} seconds".format(time() - start_time)
+
+    # Cached search results show the old scores
+    search_cache.invalidate_products()
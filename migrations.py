@@ -0,0 +1,174 @@
+## Upgrades an existing product_genius database in place.
+## Fresh databases get the current schema from db.create_all() in seed.py
+
+from model import connect_to_db, db, ProductSummary, ProductWordCount, Category
+from model import PRODUCT_SEARCH_TRIGGER, REVIEW_SEARCH_TRIGGER, CATEGORY_PATH_TRIGGER
+from indexes import create_indexes_concurrently
+
+# Product metadata that the category tree is rebuilt from
+PRODUCTS_FILE = 'data/electronics_metadata_subset.json'
+
+
+def add_search_vectors():
+    """Replace the expression search indexes with stored tsvector columns.
+
+       Adds a search_vector column to products and reviews, installs the
+       triggers that keep it up to date and backfills existing rows. The
+       old expression indexes are dropped, and create_indexes_concurrently()
+       builds the GIN indexes on the new columns without blocking writes.
+    """
+
+    print "====================="
+    print "Adding search vectors"
+
+    # The old indexes had the same names but were built on expressions.
+    # Dropping them first also spares the backfill from updating them.
+    old_indexes = db.session.execute("""SELECT indexname FROM pg_indexes
+                                        WHERE indexname IN ('idx_fts_product',
+                                                            'idx_fts_review')
+                                        AND indexdef NOT LIKE '%search_vector%';
+                                     """).fetchall()
+
+    for index_name, in old_indexes:
+        db.session.execute("DROP INDEX {};".format(index_name))
+
+    for table in ['products', 'reviews']:
+        db.session.execute("""ALTER TABLE {}
+                              ADD COLUMN IF NOT EXISTS search_vector tsvector;
+                           """.format(table))
+
+    db.session.execute(PRODUCT_SEARCH_TRIGGER)
+    db.session.execute(REVIEW_SEARCH_TRIGGER)
+
+    # Touching the text columns fires the triggers for every existing row
+    db.session.execute("UPDATE products SET title = title;")
+    db.session.execute("UPDATE reviews SET summary = summary;")
+
+    db.session.commit()
+
+
+def scores_to_integer_array():
+    """Convert products.scores from a json-encoded string to an integer[].
+
+       Existing rows hold the distribution as a json string like
+       "[0, 1, 0, 0, 5]", which is converted in place to {0,1,0,0,5}.
+    """
+
+    print "====================="
+    print "Converting score distributions to integer arrays"
+
+    data_type = db.session.execute("""SELECT data_type
+                                      FROM information_schema.columns
+                                      WHERE table_name = 'products'
+                                      AND column_name = 'scores';
+                                   """).scalar()
+
+    if data_type != 'json':
+        print "already converted"
+        return
+
+    # #>> '{}' unwraps the json string; translate turns [..] into {..}
+    db.session.execute("""ALTER TABLE products
+                          ALTER COLUMN scores TYPE integer[]
+                          USING CAST(translate(scores #>> '{}', '[]', '{}')
+                                     AS integer[]);
+                       """)
+
+    db.session.commit()
+
+
+def create_product_word_counts():
+    """Create the product_word_counts table and count every review into it.
+
+       The counts have to cover every review before new reviews are folded
+       in, so they are only rebuilt when the table is created here.
+    """
+
+    print "====================="
+    print "Creating product word counts"
+
+    if db.engine.dialect.has_table(db.engine, ProductWordCount.__tablename__):
+        print "already created"
+        return
+
+    ProductWordCount.__table__.create(db.engine, checkfirst=True)
+
+    # Imported here since it loads sklearn
+    import keyword_stats
+    keyword_stats.rebuild_word_counts()
+
+
+def create_product_summaries():
+    """Create and fill the product_summaries table if it doesn't exist yet"""
+
+    print "====================="
+    print "Creating product summaries"
+
+    ProductSummary.__table__.create(db.engine, checkfirst=True)
+    ProductSummary.refresh()
+
+
+def add_category_tree(products_file=PRODUCTS_FILE):
+    """Add the parent, materialized path and top products columns to categories.
+
+       Categories loaded before the tree existed are flat, one per name and
+       without parents. When the columns are added, they're dropped with
+       their product links and rebuilt as a tree by loading the products
+       file again, which relinks every product along its category path.
+       All of it is one transaction, so an interrupted run is retried in
+       full by the next one.
+    """
+
+    print "====================="
+    print "Adding the category tree"
+
+    has_path = db.session.execute("""SELECT EXISTS (
+                                        SELECT 1 FROM information_schema.columns
+                                        WHERE table_name = 'categories'
+                                        AND column_name = 'path');
+                                  """).scalar()
+
+    if has_path:
+        # Categories created through the ORM need the trigger for their path
+        db.session.execute(CATEGORY_PATH_TRIGGER)
+        db.session.commit()
+
+        print "already added"
+        return
+
+    db.session.execute("""ALTER TABLE categories
+                          ADD COLUMN IF NOT EXISTS parent_id integer
+                              REFERENCES categories (cat_id),
+                          ADD COLUMN IF NOT EXISTS path text,
+                          ADD COLUMN IF NOT EXISTS top_asins text[];
+                       """)
+    db.session.execute(CATEGORY_PATH_TRIGGER)
+
+    db.session.execute("DELETE FROM product_categories;")
+    db.session.execute("DELETE FROM categories;")
+
+    # Imported here since the loader loads keyword_stats and sklearn
+    from loader import load_products
+    load_products(products_file, commit=False)
+
+    # Commits the whole rebuild, with the summaries of the reloaded products
+    ProductSummary.refresh()
+
+    Category.refresh_top_products()
+
+
+##################### Run script #################################
+
+if __name__ == "__main__":
+
+    from server import app
+    connect_to_db(app)
+
+    add_search_vectors()
+    scores_to_integer_array()
+    create_product_word_counts()
+    create_product_summaries()
+    add_category_tree()
+
+    # Any index declared on the models that the db doesn't have yet
+    create_indexes_concurrently()
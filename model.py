@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
-import json
-import numpy as np
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
+from search_query import normalize_query
+from query_cache import QueryCache
 
 db = SQLAlchemy()
 
@@ -23,6 +25,57 @@ class User(db.Model):
                                        secondary='favorite_reviews',
                                        lazy="dynamic")
 
+    # The favorites queries, also EXPLAINed by indexes.check_route_queries()
+    FAVORITE_IDS_SQL = """
+        SELECT asin, NULL AS review_id
+        FROM favorite_products
+        WHERE user_id = :user_id
+        UNION ALL
+        SELECT NULL, review_id
+        FROM favorite_reviews
+        WHERE user_id = :user_id
+    """
+
+    TOGGLE_FAVORITE_PRODUCT_SQL = """
+        WITH removed AS (
+            DELETE FROM favorite_products
+            WHERE user_id = :user_id AND asin = :asin
+            RETURNING asin
+        ), removed_reviews AS (
+            DELETE FROM favorite_reviews fr
+            USING reviews r, removed
+            WHERE fr.review_id = r.review_id
+            AND fr.user_id = :user_id
+            AND r.asin = removed.asin
+        ), added AS (
+            INSERT INTO favorite_products (user_id, asin)
+            SELECT CAST(:user_id AS integer), CAST(:asin AS text)
+            WHERE NOT EXISTS (SELECT 1 FROM removed)
+            ON CONFLICT DO NOTHING
+        )
+        SELECT EXISTS (SELECT 1 FROM removed)
+    """
+
+    TOGGLE_FAVORITE_REVIEW_SQL = """
+        WITH removed AS (
+            DELETE FROM favorite_reviews
+            WHERE user_id = :user_id AND review_id = :review_id
+            RETURNING review_id
+        ), added AS (
+            INSERT INTO favorite_reviews (user_id, review_id)
+            SELECT CAST(:user_id AS integer), CAST(:review_id AS integer)
+            WHERE NOT EXISTS (SELECT 1 FROM removed)
+            ON CONFLICT DO NOTHING
+            RETURNING review_id
+        ), added_product AS (
+            INSERT INTO favorite_products (user_id, asin)
+            SELECT CAST(:user_id AS integer), r.asin
+            FROM reviews r JOIN added USING (review_id)
+            ON CONFLICT DO NOTHING
+        )
+        SELECT EXISTS (SELECT 1 FROM removed)
+    """
+
     def __init__(self, name, email, password):
         self.name = name
         self.email = email
@@ -38,6 +91,26 @@ class User(db.Model):
 
         return set(rev.review_id for rev in self.favorite_reviews)
 
+    @staticmethod
+    def fetch_favorite_ids(user_id):
+        """Return a (favorite asins, favorite review ids) tuple of sets.
+
+           Both sets come from one query that reads only the crosslink
+           tables, without loading any products or reviews.
+        """
+
+        asins = set()
+        review_ids = set()
+
+        for asin, review_id in db.session.execute(User.FAVORITE_IDS_SQL,
+                                                  {'user_id': user_id}):
+            if review_id is None:
+                asins.add(asin)
+            else:
+                review_ids.add(review_id)
+
+        return (asins, review_ids)
+
     def is_favorite_product(self, asin):
         """Return a boolean for whether a product is a user's favorite"""
 
@@ -55,40 +128,49 @@ class User(db.Model):
     def update_favorite_product(self, asin):
         """Update a product's favorited-status in a user's account"""
 
-        product = Product.query.get(asin)
+        return User.toggle_favorite_product(self.user_id, asin)
 
-        if self.is_favorite_product(asin):
+    def update_favorite_review(self, review_id):
+        """Update a review's favorited-status in a user's account"""
 
-            # If the user has favorited the item, remove the favorite from the db
-            self.favorite_products.remove(product)
-            db.session.commit()
-            return "Unfavorited"
+        return User.toggle_favorite_review(self.user_id, review_id)
 
-        else:
+    @staticmethod
+    def toggle_favorite_product(user_id, asin):
+        """Favorite or unfavorite a product in a single statement.
 
-            # If the user has not favorited the product, add it to the db
-            self.favorite_products.append(product)
-            db.session.commit()
-            return "Favorited"
+           If the product was a favorite it is removed, along with the user's
+           favorite reviews of that product. Otherwise it is added.
+           Returns "Favorited" or "Unfavorited".
+        """
 
-    def update_favorite_review(self, review_id):
-        """Update a review's favorited-status in a user's account"""
+        unfavorited = db.session.execute(User.TOGGLE_FAVORITE_PRODUCT_SQL,
+                                         {'user_id': user_id,
+                                          'asin': asin}).scalar()
+        db.session.commit()
 
-        rev = Review.query.get(review_id)
+        if unfavorited:
+            return "Unfavorited"
 
-        if self.is_favorite_review(review_id):
+        return "Favorited"
 
-            # If the user has favorited the item, remove the favorite from the db
-            self.favorite_reviews.remove(rev)
-            db.session.commit()
-            return "Unfavorited"
+    @staticmethod
+    def toggle_favorite_review(user_id, review_id):
+        """Favorite or unfavorite a review in a single statement.
 
-        else:
+           Favoriting a review also favorites its product, if the user
+           hasn't already. Returns "Favorited" or "Unfavorited".
+        """
 
-            # If the user has not favorited the review, add it to the db
-            self.favorite_reviews.append(rev)
-            db.session.commit()
-            return "Favorited"
+        unfavorited = db.session.execute(User.TOGGLE_FAVORITE_REVIEW_SQL,
+                                         {'user_id': user_id,
+                                          'review_id': review_id}).scalar()
+        db.session.commit()
+
+        if unfavorited:
+            return "Unfavorited"
+
+        return "Favorited"
 
     def add_favorite_product_from_review(self, asin):
         """Verify that a product is favorited.
@@ -98,28 +180,46 @@ class User(db.Model):
            the product.
         """
 
-        if not self.is_favorite_product(asin):
-            product = Product.query.get(asin)
-            self.favorite_products.append(product)
-            db.session.commit()
+        db.session.execute("""
+            INSERT INTO favorite_products (user_id, asin)
+            VALUES (:user_id, :asin)
+            ON CONFLICT DO NOTHING
+        """, {'user_id': self.user_id, 'asin': asin})
+        db.session.commit()
 
     def get_favorite_reviews_for_product(self, asin):
         """Return a list of review objects that a user favorited for a given product"""
 
         return self.favorite_reviews.filter_by(asin=asin).all()
 
-    def remove_favorite_reviews(self, asin):
-        """Removes all favorited reviews for a product.
+    def get_favorite_reviews_by_product(self):
+        """Return a dictionary of asin -> list of the user's favorite reviews.
 
-           This function is called when a user unfavorites a product.
+           All of the user's favorite reviews are loaded in one query, instead
+           of one query per product.
         """
 
-        # Query a user's favorite reviews for that product
-        product_fav_reviews = self.get_favorite_reviews_for_product(asin)
+        reviews_by_product = {}
+
+        for review in self.favorite_reviews.order_by(Review.asin, Review.time):
+            reviews_by_product.setdefault(review.asin, []).append(review)
+
+        return reviews_by_product
+
+    def remove_favorite_reviews(self, asin):
+        """Removes all favorited reviews for a product.
 
-        for review in product_fav_reviews:
-            self.favorite_reviews.remove(review)
+           Unfavoriting a product already does this, see
+           toggle_favorite_product().
+        """
 
+        db.session.execute("""
+            DELETE FROM favorite_reviews fr
+            USING reviews r
+            WHERE fr.review_id = r.review_id
+            AND fr.user_id = :user_id
+            AND r.asin = :asin
+        """, {'user_id': self.user_id, 'asin': asin})
         db.session.commit()
 
     @classmethod
@@ -147,11 +247,18 @@ class Product(db.Model):
     description = db.Column(db.Text)
     price = db.Column(db.Float, nullable=False)
     image = db.Column(db.Text, nullable=False)   # link to image
-    scores = db.Column(db.JSON)                  # List with 1-5 star ratings stored as json
+    scores = db.Column(ARRAY(db.Integer))        # Number of 1-5 star ratings
     n_scores = db.Column(db.Integer)
     pg_score = db.Column(db.Float)             # Product Genius score
     pos_words = db.Column(db.JSON)               # List of positive keywords stored as json
     neg_words = db.Column(db.JSON)               # List of negative keywords stored as json
+    search_vector = db.deferred(db.Column(TSVECTOR))   # Weighted title/description, kept up to date by trigger
+
+    __table_args__ = (
+        db.Index('idx_fts_product', 'search_vector', postgresql_using='gin'),
+        db.Index('idx_products_pg_score', 'pg_score'),
+        db.Index('idx_products_price', 'price'),
+    )
 
     categories = db.relationship('Category',
                                  secondary='product_categories',
@@ -161,6 +268,10 @@ class Product(db.Model):
                               order_by='Review.time',
                               back_populates='product')
 
+    # Cache for get_mean_product_score(). The ttl bounds how long processes
+    # that didn't run the rescoring keep an old mean.
+    _mean_score_cache = QueryCache(max_size=1, ttl=300)
+
     def __init__(self, asin, title, description, price, image, categories):
         self.asin = asin
         self.title = title
@@ -194,14 +305,12 @@ class Product(db.Model):
             get_scores() would return [0, 1, 0, 0, 5]
          """
 
-        return json.loads(self.scores)
+        return list(self.scores)
 
     def get_total_stars(self):
         """Return a product's total stars and n reviews as a tuple"""
 
-        scores = self.get_scores()
-
-        stars = sum(np.array(scores) * np.array([1, 2, 3, 4, 5]))
+        stars = sum(star * n for star, n in enumerate(self.scores, 1))
 
         # Return a tuple with (nstars, nscores)
         return (stars, self.n_scores)
@@ -214,52 +323,269 @@ class Product(db.Model):
 
         return pg_score
 
+    @staticmethod
+    def recompute_scores(asins=None, pg_average=3.0, C=10):
+        """Recalculate scores, n_scores and pg_score from the reviews table.
+
+           This is the set-based equivalent of calling calculate_score_distribution()
+           and calculate_pg_score() on every product: one grouped aggregation
+           over reviews written back with a single UPDATE ... FROM. Pass a list
+           of asins to only rescore those products. Their summaries and the
+           top products of their categories are refreshed afterwards.
+        """
+
+        params = {'pg_average': pg_average, 'C': C}
+        where = ""
+
+        if asins is not None:
+            where = "WHERE p.asin = ANY(:asins)"
+            params['asins'] = list(asins)
+
+        sql = """WITH counts AS (
+                    SELECT p.asin,
+                        count(r.score) FILTER (WHERE r.score = 1) AS s1,
+                        count(r.score) FILTER (WHERE r.score = 2) AS s2,
+                        count(r.score) FILTER (WHERE r.score = 3) AS s3,
+                        count(r.score) FILTER (WHERE r.score = 4) AS s4,
+                        count(r.score) FILTER (WHERE r.score = 5) AS s5,
+                        count(r.score) AS n_scores,
+                        coalesce(sum(r.score), 0) AS stars
+                    FROM products p LEFT JOIN reviews r ON r.asin = p.asin
+                    {}
+                    GROUP BY p.asin)
+                UPDATE products SET
+                    scores = CAST(ARRAY[s1, s2, s3, s4, s5] AS integer[]),
+                    n_scores = counts.n_scores,
+                    pg_score = (CAST(:C AS double precision) * :pg_average + counts.stars)
+                               / (:C + counts.n_scores)
+                FROM counts
+                WHERE products.asin = counts.asin;
+              """.format(where)
+
+        db.session.execute(sql, params)
+        db.session.commit()
+
+        Product.invalidate_mean_product_score()
+        ProductSummary.refresh(asins)
+        Category.refresh_top_products(asins)
+
     @classmethod
     def get_mean_product_score(cls):
-        """Calculate mean product score across all products."""
+        """Calculate mean product score across all products.
+
+           The mean is the total stars over the total number of scores, summed
+           in the db from the score histograms. It's cached for a few minutes,
+           or until invalidate_mean_product_score() is called.
+
+           Returns None if no product has been scored yet.
+        """
 
-        products = cls.query.all()
+        return cls._mean_score_cache.get_or_compute('mean', cls._compute_mean_product_score)
 
-        # List of product (star, nscores) tuples
-        star_tups = [pr.get_total_stars() for pr in products]
+    @staticmethod
+    def _compute_mean_product_score():
+        """Query the mean product score for get_mean_product_score()"""
+
+        sql = """SELECT sum(scores[1] + 2 * scores[2] + 3 * scores[3] +
+                            4 * scores[4] + 5 * scores[5]),
+                    sum(n_scores)
+                FROM products
+                WHERE scores IS NOT NULL;
+              """
+
+        stars, n_scores = db.session.execute(sql).first()
+
+        # sum() is NULL when there are no scored products
+        if not n_scores:
+            return None
+
+        return float(stars)/n_scores
+
+    @classmethod
+    def invalidate_mean_product_score(cls):
+        """Clear the cached mean product score after scores change"""
 
-        product_average = float(sum([tup[0] for tup in star_tups]))/sum([tup[1] for tup in star_tups])
+        cls._mean_score_cache.invalidate()
 
-        return product_average
+    # Orders that search results can be sorted in:
+    # name -> (sql expression, direction, type of the expression).
+    # Only these strings are ever put into the sql for a sort.
+    SEARCH_SORTS = {
+        "relevance": ("ts_rank(search_vector, search_query)", "DESC", "real"),
+        "pg_score": ("pg_score", "DESC", "double precision"),
+        "price": ("price", "ASC", "double precision"),
+    }
 
     @staticmethod
-    def find_products(query):
+    def get_filter_conditions(filters, params, categories=True, alias=None):
+        """Return sql conditions on products for a SearchFilters tuple.
+
+           The values are added to params. Pass categories=False to leave out
+           the category filter, and the alias of the products table when the
+           query joins other tables.
+        """
+
+        conditions = []
+
+        if filters is None:
+            return conditions
+
+        column = "{}.{{}}".format(alias) if alias else "{}"
+
+        if categories and filters.cat_ids:
+            # Products in any of the categories
+            conditions.append("""{} IN (SELECT asin FROM product_categories
+                                        WHERE cat_id = ANY(:cat_ids))"""
+                              .format(column.format("asin")))
+            params['cat_ids'] = list(filters.cat_ids)
+
+        if filters.min_price is not None:
+            conditions.append("{} >= :min_price".format(column.format("price")))
+            params['min_price'] = filters.min_price
+
+        if filters.max_price is not None:
+            conditions.append("{} <= :max_price".format(column.format("price")))
+            params['max_price'] = filters.max_price
+
+        if filters.min_n_scores is not None:
+            conditions.append("{} >= :min_n_scores".format(column.format("n_scores")))
+            params['min_n_scores'] = filters.min_n_scores
+
+        return conditions
+
+    @staticmethod
+    def find_products(query, page_size=None, cursor=None, sort="relevance", filters=None):
         """Queries database to find products based on user's search.
 
            This full-text search in postgres stems, removes stop words, applies weights
            to different fields (title is more important than description), and ranks
-           the results by relevancy.
+           the results by relevancy. A product must match all of the query's terms.
+
+           sort is one of SEARCH_SORTS, and filters is a SearchFilters tuple
+           of category ids, a price range and a minimum number of reviews.
+           Both are applied in the db, so each page is one bounded query.
+
+           Results are paged with a keyset cursor: pass the (sort_key, asin) of
+           the last product on the previous page to get the page after it. Only
+           page_size products are fetched from the db; if page_size is None, all
+           matching products are returned.
 
            Currently, the default weights in ts_rank() are used, which is 1 for 'A'
            and 0.4 for 'B'. Future goal: experiment with different weightings and/or
            a cutoff for how relevant a product has to be to return.
         """
 
-        # If the search_query is more than one word,
-        # need to format the query for sql with a '&' in between words
-        words = query.strip().split(' ')
-        search_formatted = ' & '.join(words)
+        sql, params = Product.build_search_query(query, page_size, cursor, sort, filters)
+        result = db.session.execute(sql, params)
+
+        # Returns a list of product tuples
+        return result.fetchall()
 
-        sql = """SELECT *, ts_rank(product_search.product_info,
-                to_tsquery('english', :search_terms)) AS relevancy
-                FROM (SELECT *,
-                    setweight(to_tsvector('english', title), 'A') ||
-                    setweight(to_tsvector('english', description), 'B') AS product_info
-                FROM products) product_search
-                WHERE product_search.product_info @@ to_tsquery('english', :search_terms)
-                ORDER BY relevancy DESC;
-               """
+    @staticmethod
+    def build_search_query(query, page_size=None, cursor=None, sort="relevance",
+                           filters=None):
+        """Return the (sql, params) that find_products() runs"""
+
+        sort_expression, direction, sort_type = Product.SEARCH_SORTS[sort]
+
+        # Raises InvalidQuery before going to the db if there's nothing to search
+        params = {'search_terms': normalize_query(query)}
+        conditions = Product.get_filter_conditions(filters, params)
+
+        if sort == "pg_score":
+            # Lets the pg_score index return products in order. Products that
+            # haven't been scored yet can't be shown anyway.
+            conditions.append("pg_score IS NOT NULL")
+
+        # search_vector is maintained by a trigger on products, so the GIN
+        # index is used directly and documents don't need to be re-parsed
+        sql = """SELECT * FROM (
+                    SELECT asin, title, description, price, image, scores,
+                        n_scores, pg_score, pos_words, neg_words,
+                        ts_rank(search_vector, search_query) AS relevancy,
+                        {} AS sort_key
+                    FROM products, plainto_tsquery('english', :search_terms) search_query
+                    WHERE search_vector @@ search_query
+                    {}) product_search
+              """.format(sort_expression,
+                         "".join("AND {} ".format(c) for c in conditions))
+
+        if cursor:
+            # Continue after the last product of the previous page. Compare
+            # at the precision of the sort key, ts_rank returns a real.
+            sql += """WHERE sort_key {0} CAST(:cursor_value AS {1})
+                        OR (sort_key = CAST(:cursor_value AS {1})
+                            AND asin > :cursor_asin)
+                   """.format("<" if direction == "DESC" else ">", sort_type)
+            params['cursor_value'], params['cursor_asin'] = cursor
+
+        # asin breaks ties so that the order (and the cursor) is stable
+        sql += "ORDER BY sort_key {}, asin".format(direction)
+
+        if page_size:
+            sql += " LIMIT :page_size"
+            params['page_size'] = page_size
+
+        return sql, params
 
-        cursor = db.session.execute(sql,
-                                    {'search_terms': search_formatted})
+    @staticmethod
+    def count_categories(query, filters=None, limit=20):
+        """Count the products matching a search in each category.
 
-        # Returns a list of product tuples
-        return cursor.fetchall()
+           Returns (cat_id, cat_name, n_products) rows for the limit largest
+           categories, from one grouped query over the matching products.
+           The category filter is left out, so the counts show what choosing
+           a different category would return.
+        """
+
+        sql, params = Product.build_category_count_query(query, filters, limit)
+
+        return db.session.execute(sql, params).fetchall()
+
+    @staticmethod
+    def build_category_count_query(query, filters=None, limit=20):
+        """Return the (sql, params) that count_categories() runs"""
+
+        params = {'search_terms': normalize_query(query), 'limit': limit}
+        conditions = Product.get_filter_conditions(filters, params,
+                                                   categories=False, alias="p")
+
+        sql = """SELECT c.cat_id, c.cat_name, count(*) AS n_products
+                 FROM products p
+                 JOIN product_categories pc ON pc.asin = p.asin
+                 JOIN categories c ON c.cat_id = pc.cat_id,
+                 plainto_tsquery('english', :search_terms) search_query
+                 WHERE p.search_vector @@ search_query
+                 {}
+                 GROUP BY c.cat_id, c.cat_name
+                 ORDER BY n_products DESC, c.cat_name
+                 LIMIT :limit
+              """.format("".join("AND {} ".format(c) for c in conditions))
+
+        return sql, params
+
+    @staticmethod
+    def get_reviews_page(asin, limit, before=None):
+        """Return up to limit of a product's reviews, newest first.
+
+           before is the (time, review_id) keyset of the last review on the
+           previous page, or None for the first page. Only one page of
+           reviews is loaded, however many the product has.
+        """
+
+        return Product.reviews_page_query(asin, limit, before).all()
+
+    @staticmethod
+    def reviews_page_query(asin, limit, before=None):
+        """Return the Query that get_reviews_page() runs"""
+
+        query = Review.query.filter(Review.asin == asin)
+
+        if before is not None:
+            query = query.filter(db.tuple_(Review.time, Review.review_id) < before)
+
+        return query.order_by(Review.time.desc(),
+                              Review.review_id.desc()).limit(limit)
 
 
 class Review(db.Model):
@@ -273,6 +599,13 @@ class Review(db.Model):
     score = db.Column(db.Integer, nullable=False)
     summary = db.Column(db.Text, nullable=False)
     time = db.Column(db.DateTime, nullable=False)
+    search_vector = db.deferred(db.Column(TSVECTOR))   # Weighted summary/review, kept up to date by trigger
+
+    __table_args__ = (
+        db.Index('idx_fts_review', 'search_vector', postgresql_using='gin'),
+        # Finds a product's reviews, already in the order of a reviews page
+        db.Index('idx_reviews_asin_time', 'asin', 'time', 'review_id'),
+    )
 
     # Define relationship to product
     product = db.relationship('Product',
@@ -293,80 +626,379 @@ class Review(db.Model):
                                                           self.summary)
 
     @staticmethod
-    def find_reviews(asin, query):
+    def find_reviews(asin, query, limit=None, offset=0):
         """Queries database to find product reviews based on user's search.
 
            This full-text search in postgres stems, removes stop words, applies weights
            to different fields (review summary is more important than the review text),
            and ranks the results by relevancy.
 
+           limit and offset select a page of the ranked reviews, so only the
+           reviews on that page are fetched. If limit is None, all matching
+           reviews are returned.
+
            Currently, the default weights in ts_rank() are used, which is 1 for 'A'
            and 0.4 for 'B'. Future goal: experiment with different weightings and/or
            a cutoff for how relevant a review has to be to return.
         """
 
-        # If the search_query is more than one word,
-        # need to format the query for sql with a '&' in between words
-        words = query.strip().split(' ')
-        search_formatted = ' & '.join(words)
-
-        sql = """SELECT *, ts_rank(array[0, 0, 0.8, 1], review_search.review_info,
-                    to_tsquery('english', :search_terms)) AS relevancy
-                    FROM (SELECT *,
-                        setweight(to_tsvector('english', summary), 'A') ||
-                        setweight(to_tsvector('english', review), 'B') AS review_info
-                    FROM reviews
-                    WHERE asin=:asin) review_search
-                    WHERE review_search.review_info @@ to_tsquery('english', :search_terms)
-                    ORDER BY relevancy DESC;
-              """
+        sql, params = Review.build_search_query(asin, query, limit, offset)
+        cursor = db.session.execute(sql, params)
 
-        cursor = db.session.execute(sql,
-                                    {'search_terms': search_formatted,
-                                     'asin': asin})
         return cursor.fetchall()
 
+    @staticmethod
+    def build_search_query(asin, query, limit=None, offset=0):
+        """Return the (sql, params) that find_reviews() runs"""
+
+        # Raises InvalidQuery before going to the db if there's nothing to search
+        search_terms = normalize_query(query)
+
+        # review_id breaks ties so that pages don't overlap
+        sql = """SELECT review_id, review, asin, score, summary, time,
+                    ts_rank(array[0, 0, 0.8, 1], search_vector, search_query) AS relevancy
+                FROM reviews, plainto_tsquery('english', :search_terms) search_query
+                WHERE asin=:asin AND search_vector @@ search_query
+                ORDER BY relevancy DESC, review_id
+                LIMIT :limit OFFSET :offset;
+              """
+
+        # LIMIT NULL means no limit in postgres
+        params = {'search_terms': search_terms,
+                  'asin': asin,
+                  'limit': limit,
+                  'offset': offset}
+
+        return sql, params
+
+
+class ProductWordCount(db.Model):
+    """Number of times a word appears in a product's positive and negative reviews.
+
+       These are the sufficient statistics for a product's naive bayes keywords,
+       so new reviews can be folded in without refitting on every review.
+    """
+
+    __tablename__ = "product_word_counts"
+
+    asin = db.Column(db.Text, db.ForeignKey('products.asin'), primary_key=True)
+    word = db.Column(db.Text, primary_key=True)
+    pos_count = db.Column(db.Integer, nullable=False, default=0)
+    neg_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """Display when printing a ProductWordCount object"""
+
+        return "<ProductWordCount: {} word: {} pos: {} neg: {}>".format(
+            self.asin, self.word, self.pos_count, self.neg_count)
+
+
+class ProductSummary(db.Model):
+    """Denormalized copy of what the product page shows about a product.
+
+       Rows are rebuilt from products and reviews by refresh(), which runs
+       whenever products are rescored or get new keywords, so a product page
+       is one primary key lookup instead of a product and its relationships.
+    """
+
+    __tablename__ = "product_summaries"
+
+    # Number of reviews on the product page. recent_review_ids keeps one
+    # more id than this, to know whether there are more reviews to load.
+    N_RECENT_REVIEWS = 10
+
+    asin = db.Column(db.Text, db.ForeignKey('products.asin'), primary_key=True)
+    title = db.Column(db.Text, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    image = db.Column(db.Text, nullable=False)
+    scores = db.Column(ARRAY(db.Integer))          # Number of 1-5 star ratings
+    n_scores = db.Column(db.Integer)
+    pg_score = db.Column(db.Float)
+    pos_words = db.Column(db.JSON)
+    neg_words = db.Column(db.JSON)
+    recent_review_ids = db.Column(ARRAY(db.Integer))   # Newest first, one page + 1
+
+    def __repr__(self):
+        """Display when printing a ProductSummary object"""
+
+        return "<ProductSummary: {} title: {}>".format(self.asin, self.title)
+
+    def get_scores(self):
+        """Return the number of 1-5 star ratings as a list"""
+
+        return list(self.scores or [0, 0, 0, 0, 0])
+
+    def get_recent_review_ids(self):
+        """Return the ids of the newest page of reviews, newest first"""
+
+        return list(self.recent_review_ids or [])[:self.N_RECENT_REVIEWS]
+
+    def has_more_reviews(self):
+        """Return whether the product has reviews past the newest page"""
+
+        return len(self.recent_review_ids or []) > self.N_RECENT_REVIEWS
+
+    def get_recent_reviews(self):
+        """Return the Review objects of the newest page of reviews, newest first"""
+
+        review_ids = self.get_recent_review_ids()
+
+        if not review_ids:
+            return []
+
+        reviews = self.recent_reviews_query().all()
+        order = dict((review_id, i) for i, review_id in enumerate(review_ids))
+
+        return sorted(reviews, key=lambda r: order[r.review_id])
+
+    def recent_reviews_query(self):
+        """Return the Query that get_recent_reviews() runs"""
+
+        return Review.query.filter(Review.review_id.in_(self.get_recent_review_ids()))
+
+    @classmethod
+    def get_or_refresh(cls, asin):
+        """Return a product's summary, building it first if it's missing.
+
+           Returns None if there's no such product.
+        """
+
+        summary = cls.query.get(asin)
+
+        if summary is None:
+            cls.refresh([asin])
+            summary = cls.query.get(asin)
+
+        return summary
+
+    @classmethod
+    def refresh(cls, asins=None):
+        """Rebuild the summaries of a list of asins, or of every product"""
+
+        # One review past the page shows whether there are more
+        params = {'n_reviews': cls.N_RECENT_REVIEWS + 1}
+        where = ""
+
+        if asins is not None:
+            where = "WHERE p.asin = ANY(:asins)"
+            params['asins'] = list(asins)
+
+        sql = """INSERT INTO product_summaries (asin, title, price, image, scores,
+                                                n_scores, pg_score, pos_words,
+                                                neg_words, recent_review_ids)
+                 SELECT p.asin, p.title, p.price, p.image, p.scores, p.n_scores,
+                        p.pg_score, p.pos_words, p.neg_words,
+                        ARRAY(SELECT r.review_id
+                              FROM reviews r
+                              WHERE r.asin = p.asin
+                              ORDER BY r.time DESC, r.review_id DESC
+                              LIMIT :n_reviews)
+                 FROM products p
+                 {}
+                 ON CONFLICT (asin) DO UPDATE SET
+                    title = EXCLUDED.title,
+                    price = EXCLUDED.price,
+                    image = EXCLUDED.image,
+                    scores = EXCLUDED.scores,
+                    n_scores = EXCLUDED.n_scores,
+                    pg_score = EXCLUDED.pg_score,
+                    pos_words = EXCLUDED.pos_words,
+                    neg_words = EXCLUDED.neg_words,
+                    recent_review_ids = EXCLUDED.recent_review_ids;
+              """.format(where)
+
+        db.session.execute(sql, params)
+        db.session.commit()
+
 
 class Category(db.Model):
-    """Product categories"""
+    """Product categories.
+
+       Categories form a tree, from the ordered category paths in the
+       product data, ex: Electronics > Accessories > Headphones. path is the
+       materialized path of cat_ids from the root, ex: "1.5.9". Products are
+       linked to every category along their path.
+    """
 
     __tablename__ = "categories"
 
+    # Number of products kept in top_asins
+    N_TOP_PRODUCTS = 20
+
     cat_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     cat_name = db.Column(db.Text)
+    parent_id = db.Column(db.Integer, db.ForeignKey('categories.cat_id'))
+    path = db.Column(db.Text, server_default=db.FetchedValue())   # Set by trigger on insert
+    top_asins = db.Column(ARRAY(db.Text))   # Best products by pg_score, best first
+
+    __table_args__ = (
+        db.Index('idx_categories_parent_id', 'parent_id'),
+    )
 
     products = db.relationship('Product',
                                secondary='product_categories',
                                back_populates='categories')
 
-    def __init__(self, cat_name):
+    children = db.relationship('Category',
+                               order_by='Category.cat_name',
+                               backref=db.backref('parent', remote_side=[cat_id]))
+
+    def __init__(self, cat_name, parent_id=None):
         self.cat_name = cat_name
+        self.parent_id = parent_id
 
     def __repr__(self):
         """Display when printing a Category object"""
 
         return "<Category: {}>".format(self.cat_name)
 
+    def get_ancestors(self):
+        """Return the categories above this one, starting at the root"""
+
+        if not self.path:
+            return []
+
+        ancestor_ids = [int(cat_id) for cat_id in self.path.split('.')[:-1]]
+
+        if not ancestor_ids:
+            return []
+
+        ancestors = Category.query.filter(Category.cat_id.in_(ancestor_ids)).all()
+
+        return sorted(ancestors, key=lambda c: ancestor_ids.index(c.cat_id))
+
+    def get_top_products(self):
+        """Return the ProductSummary of each product in top_asins, best first"""
+
+        if not self.top_asins:
+            return []
+
+        summaries = self.top_products_query().all()
+        order = dict((asin, i) for i, asin in enumerate(self.top_asins))
+
+        return sorted(summaries, key=lambda s: order[s.asin])
+
+    def top_products_query(self):
+        """Return the Query that get_top_products() runs"""
+
+        return ProductSummary.query.filter(ProductSummary.asin.in_(self.top_asins))
+
+    @classmethod
+    def refresh_top_products(cls, asins=None):
+        """Recompute top_asins for every category, or only for the categories
+           of a list of asins.
+        """
+
+        params = {'n_products': cls.N_TOP_PRODUCTS}
+        where = ""
+
+        if asins is not None:
+            where = """WHERE c.cat_id IN (SELECT cat_id FROM product_categories
+                                          WHERE asin = ANY(:asins))"""
+            params['asins'] = list(asins)
+
+        sql = """UPDATE categories c SET
+                    top_asins = ARRAY(SELECT p.asin
+                                      FROM product_categories pc
+                                      JOIN products p ON p.asin = pc.asin
+                                      WHERE pc.cat_id = c.cat_id
+                                      AND p.pg_score IS NOT NULL
+                                      ORDER BY p.pg_score DESC, p.asin
+                                      LIMIT :n_products)
+                 {};
+              """.format(where)
+
+        db.session.execute(sql, params)
+        db.session.commit()
+
 
 # Crosslink between products and categories
 product_categories = db.Table('product_categories',
     db.Column('asin', db.Text, db.ForeignKey('products.asin'), primary_key=True),
-    db.Column('cat_id', db.Integer, db.ForeignKey('categories.cat_id'), primary_key=True)
+    db.Column('cat_id', db.Integer, db.ForeignKey('categories.cat_id'), primary_key=True),
+    db.Index('idx_product_categories_cat_id', 'cat_id')
 )
 
 # Crosslink between users and favorited products
 favorite_products = db.Table('favorite_products',
     db.Column('user_id', db.Integer, db.ForeignKey('users.user_id'), primary_key=True),
-    db.Column('asin', db.Text, db.ForeignKey('products.asin'), primary_key=True)
+    db.Column('asin', db.Text, db.ForeignKey('products.asin'), primary_key=True),
+    db.Index('idx_favorite_products_asin', 'asin')
 )
 
 # Crosslink between users and favorited reviews
 favorite_reviews = db.Table('favorite_reviews',
     db.Column('user_id', db.Integer, db.ForeignKey('users.user_id'), primary_key=True),
-    db.Column('review_id', db.Integer, db.ForeignKey('reviews.review_id'), primary_key=True)
+    db.Column('review_id', db.Integer, db.ForeignKey('reviews.review_id'), primary_key=True),
+    db.Index('idx_favorite_reviews_review_id', 'review_id')
 )
 
 
+##############################################################################
+# Triggers
+
+# The search vectors are computed by postgres whenever a row is inserted or its
+# text changes, so bulk loads and ORM writes both keep them up to date.
+PRODUCT_SEARCH_TRIGGER = """
+    CREATE OR REPLACE FUNCTION products_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS products_search_vector_trigger ON products;
+    CREATE TRIGGER products_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF title, description ON products
+        FOR EACH ROW EXECUTE PROCEDURE products_search_vector_update();
+    """
+
+REVIEW_SEARCH_TRIGGER = """
+    CREATE OR REPLACE FUNCTION reviews_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', coalesce(NEW.summary, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(NEW.review, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS reviews_search_vector_trigger ON reviews;
+    CREATE TRIGGER reviews_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF summary, review ON reviews
+        FOR EACH ROW EXECUTE PROCEDURE reviews_search_vector_update();
+    """
+
+# Categories inserted without a path get their parent's path plus their own
+# id, so categories created through the ORM have one too
+CATEGORY_PATH_TRIGGER = """
+    CREATE OR REPLACE FUNCTION categories_path_update() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.path IS NULL THEN
+            NEW.path := coalesce((SELECT path || '.' FROM categories
+                                  WHERE cat_id = NEW.parent_id), '') || NEW.cat_id;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS categories_path_trigger ON categories;
+    CREATE TRIGGER categories_path_trigger
+        BEFORE INSERT ON categories
+        FOR EACH ROW EXECUTE PROCEDURE categories_path_update();
+    """
+
+# Create the triggers along with the tables in db.create_all()
+event.listen(Product.__table__, 'after_create',
+             db.DDL(PRODUCT_SEARCH_TRIGGER).execute_if(dialect='postgresql'))
+event.listen(Review.__table__, 'after_create',
+             db.DDL(REVIEW_SEARCH_TRIGGER).execute_if(dialect='postgresql'))
+event.listen(Category.__table__, 'after_create',
+             db.DDL(CATEGORY_PATH_TRIGGER).execute_if(dialect='postgresql'))
+
+
 ##############################################################################
 # Helper functions
 
@@ -0,0 +1,63 @@
+# Closed-form naive bayes keyword scorer.
+# Computes the same keyword rankings as fitting sklearn's MultinomialNB and
+# comparing feature_log_prob_, using only numpy.
+
+import numpy as np
+
+
+def nb_log_probs(pos_counts, neg_counts, alpha=1.0):
+    """Return (log P(word | positive), log P(word | negative)) for every word.
+
+    pos_counts and neg_counts are the number of times each word appears in
+    positive and negative reviews. Probabilities are smoothed with alpha,
+    exactly like MultinomialNB.feature_log_prob_.
+    """
+
+    smoothed_pos = np.asarray(pos_counts, dtype=np.float64) + alpha
+    smoothed_neg = np.asarray(neg_counts, dtype=np.float64) + alpha
+
+    pos_log_prob = np.log(smoothed_pos) - np.log(smoothed_pos.sum())
+    neg_log_prob = np.log(smoothed_neg) - np.log(smoothed_neg.sum())
+
+    return (pos_log_prob, neg_log_prob)
+
+
+def nb_log_ratios(pos_counts, neg_counts, alpha=1.0):
+    """Return log P(word | positive) - log P(word | negative) for every word"""
+
+    pos_log_prob, neg_log_prob = nb_log_probs(pos_counts, neg_counts, alpha)
+
+    return pos_log_prob - neg_log_prob
+
+
+def top_words(scores, features, n_words=10):
+    """Return the n_words features with the highest scores.
+
+    Ties are broken by the word in descending order, matching
+    sorted(zip(scores, features), reverse=True)[:n_words]. Only the candidates
+    found by argpartition are sorted, not the whole vocabulary.
+    """
+
+    features = np.asarray(features)
+
+    if len(scores) > n_words:
+        # Every word scoring at least the n-th highest score is a candidate,
+        # so that ties at the cutoff are broken the same way as a full sort
+        top = np.argpartition(scores, -n_words)[-n_words:]
+        candidates = np.flatnonzero(scores >= scores[top].min())
+    else:
+        candidates = np.arange(len(scores))
+
+    order = np.lexsort((features[candidates], scores[candidates]))[::-1]
+
+    return features[candidates[order[:n_words]]].tolist()
+
+
+def nb_keywords(pos_counts, neg_counts, features, n_words=10, alpha=1.0):
+    """Return (pos_words, neg_words), the words most likely in each class"""
+
+    pos_probs = nb_log_ratios(pos_counts, neg_counts, alpha)
+    neg_probs = -pos_probs
+
+    return (top_words(pos_probs, features, n_words),
+            top_words(neg_probs, features, n_words))
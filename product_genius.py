@@ -1,5 +1,6 @@
-from model import User
 from model import connect_to_db, db
+from favorites_cache import get_favorite_ids
+from datetime import datetime
 import json
 
 
@@ -21,34 +22,96 @@ def get_chart_data(score_list):
 
     return data_dict
 
+
+def get_scores_etag(n_scores, score_list):
+    """Return an etag for a product's histogram, ex: "2-0-1-0-0-1"
+
+       It only changes when the number of scores or their distribution does.
+    """
+
+    return "-".join(str(n) for n in [n_scores or 0] + list(score_list))
+
+
+def encode_search_cursor(product):
+    """Build the cursor string for the page after a product search result.
+
+       The cursor is the (sort_key, asin) keyset of the last product on the
+       current page, ex: "0.0607927:B00001P4ZH"
+    """
+
+    return "{!r}:{}".format(product.sort_key, product.asin)
+
+
+def decode_search_cursor(cursor):
+    """Parse a cursor string into a (sort_key, asin) tuple.
+
+       Returns None if the cursor is malformed.
+    """
+
+    relevancy, _, asin = cursor.partition(':')
+
+    try:
+        return (float(relevancy), asin) if asin else None
+    except ValueError:
+        return None
+
+
+def encode_review_cursor(review):
+    """Build the cursor string for the page of reviews after a review.
+
+       The cursor is the (time, review_id) keyset of the last review on the
+       current page, ex: "2014-05-03T17:45:35:2"
+    """
+
+    return "{}:{}".format(review.time.isoformat(), review.review_id)
+
+
+def decode_review_cursor(cursor):
+    """Parse a cursor string into a (time, review_id) tuple.
+
+       Returns None if the cursor is malformed.
+    """
+
+    time, _, review_id = cursor.rpartition(':')
+
+    time_format = "%Y-%m-%dT%H:%M:%S"
+
+    if "." in time:
+        time_format += ".%f"
+
+    try:
+        return (datetime.strptime(time, time_format), int(review_id))
+    except ValueError:
+        return None
+
+
 def format_reviews_to_dicts(reviews, user_id):
-    """Format a list of review tuples into a list of dictionaries.
+    """Format a list of reviews into a list of dictionaries.
 
+       reviews can be Review objects or rows with the same attributes.
        This list will be sent to the front-end via json
     """
 
     # When constructing the list of review dictionaries, we could
     # query the database everytime to see if the review is the user's
-    # favorite. To be more efficient, I extracted all of the user's
-    # favorite reviews as a set of their id's, so that lookup time is
-    # constant when constructing the list of dictionaries.
+    # favorite. Instead the user's favorite review ids come from the
+    # favorites cache as a set, so lookup time is constant.
     favorite_review_ids = set()
 
     if user_id:
-        user = User.query.get(user_id)
-        favorite_review_ids = user.get_favorite_review_ids()
+        favorite_review_ids = get_favorite_ids(user_id).review_ids
 
     rev_dict_list = []
 
-    for review_id, review, asin, score, summary, time, _, _ in reviews:
+    for rev in reviews:
         rev_dict = {}
-        rev_dict["review_id"] = review_id
-        rev_dict["review"] = review
-        rev_dict["summary"] = summary
-        rev_dict["score"] = score
-        rev_dict["time"] = time
+        rev_dict["review_id"] = rev.review_id
+        rev_dict["review"] = rev.review
+        rev_dict["summary"] = rev.summary
+        rev_dict["score"] = rev.score
+        rev_dict["time"] = rev.time
         rev_dict["user"] = user_id       # Is user logged in?
-        rev_dict["favorite"] = review_id in favorite_review_ids   # Boolean of whether review is favorited
+        rev_dict["favorite"] = rev.review_id in favorite_review_ids   # Boolean of whether review is favorited
         rev_dict_list.append(rev_dict)
 
     return rev_dict_list
@@ -0,0 +1,83 @@
+"""Bounded, expiring in-process cache for query results"""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class QueryCache(object):
+    """Bounded LRU cache of query results that expire after ttl seconds.
+
+       Any object with the same get_or_compute, invalidate and stats methods
+       can be swapped in for one of the caches built from this class.
+    """
+
+    def __init__(self, max_size=500, ttl=300, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (expiry time, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return (found, value) for a key, counting the hit or miss"""
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or entry[0] <= self.clock():
+                self.misses += 1
+                return (False, None)
+
+            # Re-insert to mark the key as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return (True, entry[1])
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries if full"""
+
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + self.ttl, value)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key, or compute, cache and return it"""
+
+        found, value = self.get(key)
+
+        if not found:
+            value = compute()
+            self.set(key, value)
+
+        return value
+
+    def invalidate(self, match=None):
+        """Drop every entry, or only the entries whose key satisfies match"""
+
+        with self._lock:
+            if match is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if match(k)]:
+                    del self._entries[key]
+
+    def stats(self):
+        """Return hit/miss counters and the current size as a dictionary"""
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._entries),
+                    "max_size": self.max_size,
+                    "ttl": self.ttl}
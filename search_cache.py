@@ -0,0 +1,73 @@
+"""In-process cache for product and review search results"""
+
+from model import Product, Review
+from query_cache import QueryCache
+from search_query import normalize_query
+
+
+product_search_cache = QueryCache()
+review_search_cache = QueryCache(max_size=2000)
+category_count_cache = QueryCache()
+
+
+def find_products(query, page_size=None, cursor=None, sort="relevance", filters=None):
+    """Cached Product.find_products.
+
+       Equivalent queries share an entry since the key uses the canonical
+       form of the query. Raises InvalidQuery without touching the cache.
+    """
+
+    key = (normalize_query(query), page_size, cursor, sort, filters)
+
+    return product_search_cache.get_or_compute(
+        key, lambda: Product.find_products(query, page_size, cursor, sort, filters))
+
+
+def count_categories(query, filters=None):
+    """Cached Product.count_categories. Raises InvalidQuery like find_products.
+
+       The counts don't depend on the category filter, so searches that only
+       differ by category share an entry.
+    """
+
+    if filters is not None:
+        filters = filters._replace(cat_ids=())
+
+    key = (normalize_query(query), filters)
+
+    return category_count_cache.get_or_compute(
+        key, lambda: Product.count_categories(query, filters))
+
+
+def find_reviews(asin, query, limit=None, offset=0):
+    """Cached Review.find_reviews. Raises InvalidQuery like find_products."""
+
+    key = (asin, normalize_query(query), limit, offset)
+
+    return review_search_cache.get_or_compute(
+        key, lambda: Review.find_reviews(asin, query, limit, offset))
+
+
+def invalidate_products():
+    """Clear cached product searches after products are added or rescored"""
+
+    product_search_cache.invalidate()
+    category_count_cache.invalidate()
+
+
+def invalidate_reviews(asins=None):
+    """Clear cached review searches for the given products, or all of them"""
+
+    if asins is None:
+        review_search_cache.invalidate()
+    else:
+        asins = set(asins)
+        review_search_cache.invalidate(lambda key: key[0] in asins)
+
+
+def get_cache_stats():
+    """Return hit/miss counters for the search caches"""
+
+    return {"products": product_search_cache.stats(),
+            "reviews": review_search_cache.stats(),
+            "categories": category_count_cache.stats()}
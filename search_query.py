@@ -0,0 +1,57 @@
+"""Normalizes user search queries before they are sent to postgres"""
+
+import re
+from collections import namedtuple
+
+# Queries longer than this are rejected rather than sent to the db
+MAX_QUERY_LENGTH = 200
+
+# Search terms are runs of letters, digits and underscores. Everything else
+# (punctuation, tsquery operators like & | ! :) only separates terms.
+TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+# Filters for a product search. cat_ids is a sorted tuple of category ids, and
+# any of the others can be None for no limit. Tuples are hashable, so the
+# filters can be part of a cache key.
+SearchFilters = namedtuple('SearchFilters', ['cat_ids', 'min_price', 'max_price',
+                                             'min_n_scores'])
+
+
+class InvalidQuery(ValueError):
+    """Raised for a search query that can't match anything"""
+
+
+def normalize_query(query):
+    """Return the canonical form of a search query.
+
+       The canonical form is the query's unique lowercased terms, sorted and
+       joined by single spaces, ex: "Sony  headphones, SONY!" -> "headphones sony"
+
+       Since search terms are and-ed together, queries with the same canonical
+       form return the same results, so it is also used as the cache key. The
+       result is safe to pass to plainto_tsquery().
+
+       Raises InvalidQuery if the query is missing, too long or has no terms.
+    """
+
+    if not query or len(query) > MAX_QUERY_LENGTH:
+        raise InvalidQuery(query)
+
+    terms = set(TERM_PATTERN.findall(query.lower()))
+
+    if not terms:
+        raise InvalidQuery(query)
+
+    return ' '.join(sorted(terms))
+
+
+def make_search_filters(cat_ids=(), min_price=None, max_price=None, min_n_scores=None):
+    """Return SearchFilters with the category ids deduplicated and sorted,
+       so that equivalent filters compare equal.
+    """
+
+    return SearchFilters(cat_ids=tuple(sorted(set(cat_ids))),
+                         min_price=min_price,
+                         max_price=max_price,
+                         min_n_scores=min_n_scores)
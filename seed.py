@@ -2,163 +2,117 @@
 ## and fake user data
 
 from model import connect_to_db, db
-from model import Product, Review, User, Category
+from model import Product, Review, User
 from server import app
+from loader import iter_batches, report_progress
+from loader import load_products, load_reviews, count_scores
 from faker import Faker
 from random import randint, sample
-from datetime import datetime
-import json
-from HTMLParser import HTMLParser
-from keyword_extraction import get_keywords_from_naive_bayes
+from time import time
+from multiprocessing import Pool
+from collections import defaultdict
+from keyword_extraction import extract_keywords
+from keyword_extraction import build_review_matrix, get_catalog_keywords
+from keyword_stats import save_keywords
+import keyword_stats
+import indexes
 
 
-##################### Seed Products ###########################
+# Number of products sent to the keyword extraction workers at a time
+KEYWORD_BATCH_SIZE = 200
 
-def load_products(filename):
-    """Load products from json-like file into database."""
 
-    print "=================="
-    print "loading products"
+##################### Seed Keywords ###########################
 
-    f = open(filename)
+def extract_product_keywords_from_reviews(n_workers=None,
+                                          batch_size=KEYWORD_BATCH_SIZE,
+                                          start_after=None):
+    """Extract the top ten positive and negative keywords from reviews.
 
-    for line in f:
-        # Each line is a dictionary containing info on a product
-        p = eval(line)
+       Products are processed in asin order, in batches. The review text for a
+       batch is fetched in one query and the products are fanned out to a pool
+       of n_workers processes (defaults to the number of cpus). Keywords are
+       written back in one transaction per batch.
 
-        # categories are stored in double brackets for weird semi-json reasons
-        categories = p['categories'][0]
+       The last asin of each committed batch is printed. To resume an
+       interrupted run, pass it as start_after.
+    """
 
-        for c in categories:
-            # Loop through each of the product's categories, add to the
-            # categories table if it's not there
-
-            n_results = Category.query.filter_by(cat_name=c).count()
-
-            if n_results == 0:
-                category = Category(cat_name=c)
-                db.session.add(category)
-                db.session.commit()
-
-        # Pull out the product's categories again as a list of Category objects
-        category_objects = Category.query.filter(Category.cat_name.in_(categories)).all()
-
-        title = p.get('title')
-        if title:
-            title = H.unescape(title)
-
-        description = p.get('description')
-        if description:
-            description = H.unescape(description)
-
-        # Instantiate a product object
-        product = Product(asin=p['asin'],
-                          title=title,
-                          description=description,
-                          price=p.get('price'),
-                          image=p.get('imUrl'),
-                          categories=category_objects)
-
-        db.session.add(product)
-        db.session.commit()
-
-
-
-##################### Seed Reviews ###########################
-
-def load_reviews(filename):
-    """Load reviews from json-like file into database."""
+    print "======================"
+    print "extracting keywords"
 
-    print "=================="
-    print "loading reviews"
+    products = db.session.query(Product.asin, Product.title).order_by(Product.asin)
 
-    f = open(filename)
+    if start_after:
+        products = products.filter(Product.asin > start_after)
 
-    for line in f:
-        # Each line is a review for one product in the products table
-        r = eval(line)
+    products = products.all()
 
-        review_time = datetime.strptime(r['reviewTime'], '%m %d, %Y')
+    pool = Pool(n_workers)
 
-        summary = H.unescape(r['summary'])
-        review = H.unescape(r['reviewText'])
+    n_products = 0
+    start_time = time()
 
-        # Create a new review object and add it to the reviews table
-        review = Review(review=r['reviewText'],
-                        asin=r['asin'],
-                        score=r['overall'],
-                        summary=summary,
-                        time=review_time)
+    for batch in iter_batches(products, batch_size):
 
-        db.session.add(review)
+        asins = [asin for asin, _ in batch]
 
-    db.session.commit()
+        # Map of asin -> list of (score, review text) for the batch.
+        # Reviews with a score of 3 aren't used by naive bayes.
+        reviews = defaultdict(list)
 
+        batch_reviews = db.session.query(Review.asin, Review.score, Review.review).filter(
+            Review.asin.in_(asins), Review.score != 3)
 
-def create_search_indexes():
-    """Create a prostgres search index on products and reviews """
+        for asin, score, review in batch_reviews:
+            reviews[asin].append((score, review))
 
-    print "====================="
-    print "Creating search indexes"
+        # Run naive bayes to extract the 10 keywords with the highest
+        # likelihood of being in positive and negative reviews
+        tasks = [(asin, title, reviews.pop(asin, [])) for asin, title in batch]
+        keywords = pool.map(extract_keywords, tasks)
 
-    pr_index = """CREATE INDEX idx_fts_product ON products
-                  USING gin((setweight(to_tsvector('english', title), 'A') ||
-                  setweight(to_tsvector('english', description), 'B')));
-               """
+        save_keywords(keywords)
 
-    rev_index = """CREATE INDEX idx_fts_review ON reviews
-                   USING gin((setweight(to_tsvector('english', summary), 'A') ||
-                   setweight(to_tsvector('english', review), 'B')));
-                """
+        n_products += len(batch)
+        report_progress("products' keywords", n_products, start_time)
+        print "last asin: {}".format(asins[-1])
 
-    db.session.execute(pr_index)
-    db.session.execute(rev_index)
+    pool.close()
+    pool.join()
 
-    db.session.commit()
 
+def extract_catalog_keywords(batch_size=KEYWORD_BATCH_SIZE):
+    """Extract keywords for every product from one catalog-wide word count matrix.
 
-def count_scores():
-    """Calculate score distribution, pg-score and update product object in db """
+       An alternative to extract_product_keywords_from_reviews() that tokenizes
+       all reviews once instead of fitting a vectorizer per product. It holds
+       the whole review corpus in memory and can't be resumed.
+    """
 
     print "======================"
-    print "calculating review distributions"
+    print "extracting keywords from the review matrix"
 
-    for product in Product.query.all():
+    start_time = time()
 
-        # Loop through all products. Calculate the distribution of reviews
-        # and add to the database as a json. Also add the number of reviews
-        score_distribution = product.calculate_score_distribution()
-        product.scores = json.dumps(score_distribution)
-        product.n_scores = sum(score_distribution)
-        product.pg_score = product.calculate_pg_score()
+    titles = dict(db.session.query(Product.asin, Product.title))
 
-        db.session.commit()
+    reviews = db.session.query(Review.asin, Review.score, Review.review).filter(
+        Review.score != 3).order_by(Review.asin)
 
+    matrix = build_review_matrix(reviews)
 
-def extract_product_keywords_from_reviews():
-    """Extract the top ten positive and negative keywords from reviews"""
+    print "built {} x {} review matrix in {:.1f} seconds".format(
+        matrix.X.shape[0], matrix.X.shape[1], time() - start_time)
 
-    print "======================"
-    print "extracting keywords"
+    n_products = 0
 
-    for product in Product.query.all():
+    for batch in iter_batches(get_catalog_keywords(matrix, titles), batch_size):
 
-        # Loop through all products. Run naive bayes to extract the 10
-        # keywords with the highest likelihood of being in positive
-        # and negative reviews
+        save_keywords(batch)
 
-        # Include the product's name as stop words
-        more_stop_words = product.title.split(' ')
-        more_stop_words = [w.lower() for w in more_stop_words]
-
-        # keywords is a tuple with a list of positive keywords and negative keywords
-        keywords = get_keywords_from_naive_bayes(product, more_stop_words)
-
-        # need to do tuple unpacking
-        product.pos_words = keywords[0]
-        product.neg_words = keywords[1]
-
-        db.session.commit()
+        n_products += len(batch)
+        report_progress("products' keywords", n_products, start_time)
 
 
 ##################### Seed User data ###############################
@@ -217,12 +171,16 @@ if __name__ == "__main__":
     # In case tables haven't been created, create them
     db.create_all()
 
-    H = HTMLParser()
-
+    # Build the indexes once after the bulk loads, instead of row by row.
+    # Everything after the loads looks reviews and categories up by product,
+    # so the indexes have to be back before then.
+    indexes.drop_indexes()
     load_products('data/electronics_metadata_subset.json')
-    load_reviews('data/electronics_reviews_subset.json')
+    load_reviews('data/electronics_reviews_subset.json', rescore=False)
+    indexes.create_indexes_concurrently()
+
     count_scores()
     extract_product_keywords_from_reviews()
-    create_search_indexes()
+    keyword_stats.rebuild_word_counts()
     create_users()
     create_favorite_products()
@@ -1,10 +1,15 @@
 """ReviewGenius"""
 
-from flask import Flask, render_template, redirect, request, flash, session, jsonify
+from flask import Flask, render_template, redirect, request, flash, session, jsonify, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from jinja2 import StrictUndefined
-from model import User, Product, Review, connect_to_db
-from product_genius import get_chart_data, format_reviews_to_dicts
+from model import User, Product, Review, ProductSummary, Category, connect_to_db
+from product_genius import get_chart_data, get_scores_etag, format_reviews_to_dicts
+from product_genius import encode_search_cursor, decode_search_cursor
+from product_genius import encode_review_cursor, decode_review_cursor
+from search_query import InvalidQuery, make_search_filters
+import search_cache
+import favorites_cache
 import json
 
 app = Flask(__name__)
@@ -15,6 +20,17 @@ app.secret_key = "ProductGenius"
 # Jinja2 should raise error if it encounters an undefined variable
 app.jinja_env.undefined = StrictUndefined
 
+# Number of products shown on each page of search results
+SEARCH_PAGE_SIZE = 20
+
+# Seconds browsers may reuse a product's histogram data without asking again.
+# The scores only change when reviews are ingested.
+SCORES_MAX_AGE = 300
+
+# Number of reviews returned by each call to the review search, and shown on
+# each page of a product's reviews
+REVIEW_PAGE_SIZE = 10
+
 
 @app.route('/')
 def display_homepage():
@@ -27,40 +43,146 @@ def display_homepage():
 def search_products():
     """Retrieve data from search form and display product results page."""
 
-    search_query = request.args.get('query')
+    search_query = request.args.get('query', '')
+
+    # One of Product.SEARCH_SORTS
+    sort = request.args.get('sort', 'relevance')
+
+    if sort not in Product.SEARCH_SORTS:
+        abort(400)
+
+    # Values that don't parse are ignored, like a blank price box
+    filters = make_search_filters(
+        cat_ids=request.args.getlist('category', type=int),
+        min_price=request.args.get('min_price', type=float),
+        max_price=request.args.get('max_price', type=float),
+        min_n_scores=request.args.get('min_reviews', type=int))
+
+    cursor = None
 
-    # Retrieve products from db that match search_query within search_index
-    products = Product.find_products(search_query)
+    if request.args.get('cursor'):
+        cursor = decode_search_cursor(request.args.get('cursor'))
+
+        if cursor is None:
+            abort(400)
+
+    # Retrieve one page of products from db that match search_query within
+    # search_index. Fetch one extra product to know if there's a next page.
+    try:
+        products = search_cache.find_products(search_query,
+                                              page_size=SEARCH_PAGE_SIZE + 1,
+                                              cursor=cursor,
+                                              sort=sort,
+                                              filters=filters)
+
+        # Number of matching products in each category
+        category_counts = search_cache.count_categories(search_query, filters)
+    except InvalidQuery:
+        # Nothing searchable in the query, so don't bother the db
+        products = []
+        category_counts = []
+
+    next_cursor = None
+
+    if len(products) > SEARCH_PAGE_SIZE:
+        products = products[:SEARCH_PAGE_SIZE]
+        next_cursor = encode_search_cursor(products[-1])
+
+    # The arguments that reproduce this search, for the next page link
+    search_args = {"query": search_query,
+                   "sort": sort,
+                   "category": list(filters.cat_ids),
+                   "min_price": filters.min_price,
+                   "max_price": filters.max_price,
+                   "min_reviews": filters.min_n_scores}
 
     return render_template("product_listing.html",
                            query=search_query,
-                           products=products)
+                           products=products,
+                           next_cursor=next_cursor,
+                           search_args=search_args,
+                           category_counts=category_counts,
+                           sorts=sorted(Product.SEARCH_SORTS))
+
+
+@app.route('/category/<int:cat_id>')
+def browse_category(cat_id):
+    """Display the best products in a category by Product Genius score.
+
+       The list is precomputed after rescoring, so the page costs the same
+       however many products the category has.
+    """
+
+    category = Category.query.get(cat_id)
+
+    if category is None:
+        abort(404)
+
+    return render_template("category.html",
+                           category=category,
+                           ancestors=category.get_ancestors(),
+                           products=category.get_top_products())
 
 
 @app.route('/product-scores/<asin>.json')
 def product_reviews_data(asin):
-    """Return data about product reviews for histogram."""
+    """Return data about product reviews for histogram.
+
+       The product page embeds this data, so the route is for other clients.
+       Responses carry an ETag of the histogram, and clients that send it back
+       in If-None-Match get a 304 while the scores are unchanged.
+    """
+
+    product = ProductSummary.get_or_refresh(asin)
+
+    if product is None:
+        abort(404)
 
-    product = Product.query.get(asin)
     score_list = product.get_scores()
 
     # Formatting for a chart.js object
     data_dict = get_chart_data(score_list)
 
-    return jsonify(data_dict)
+    response = jsonify(data_dict)
+    response.set_etag(get_scores_etag(product.n_scores, score_list))
+    response.cache_control.public = True
+    response.cache_control.max_age = SCORES_MAX_AGE
+
+    return response.make_conditional(request)
 
 
 @app.route('/search-review/<asin>.json')
 def search_reviews(asin):
     """Perform full-text search within product reviews.
-       Returns the matching reviews via json to the front end.
+       Returns a page of the matching reviews via json to the front end,
+       with the number of the next page, or null on the last page.
     """
 
     search_query = request.args.get('query')
 
+    # Pages start at 1. The front end requests the next page as the user
+    # scrolls to the bottom of the results.
+    page = request.args.get('page', 1, type=int)
+
+    if page < 1:
+        abort(400)
+
     # Run full-text search within a product's reviews
-    # Return a list of review tuples.
-    reviews = Review.find_reviews(asin, search_query)
+    # Return a list of review tuples for the requested page only,
+    # with one extra review to know if there's a next page.
+    try:
+        reviews = search_cache.find_reviews(asin,
+                                            search_query,
+                                            limit=REVIEW_PAGE_SIZE + 1,
+                                            offset=(page - 1) * REVIEW_PAGE_SIZE)
+    except InvalidQuery:
+        reviews = []
+
+    next_page = None
+
+    if len(reviews) > REVIEW_PAGE_SIZE:
+        reviews = reviews[:REVIEW_PAGE_SIZE]
+        next_page = page + 1
 
     user_id = None
 
@@ -68,9 +190,18 @@ def search_reviews(asin):
         user_id = session["user"]["id"]
 
     # Converts list of review tuples into a list of dictionaries
-    review_dict_list = format_reviews_to_dicts(reviews, user_id)
+    return jsonify({"reviews": format_reviews_to_dicts(reviews, user_id),
+                    "next": next_page})
 
-    return jsonify(review_dict_list[:10])
+
+@app.route('/cache-stats.json')
+def cache_stats():
+    """Return hit/miss counters of the search and favorites caches for monitoring."""
+
+    stats = search_cache.get_cache_stats()
+    stats["favorites"] = favorites_cache.get_cache_stats()
+
+    return jsonify(stats)
 
 
 @app.route('/product/<asin>')
@@ -82,28 +213,87 @@ def display_product_profile(asin):
        reviews (that returns w/ ajax), and a heart to favorite the product.
     """
 
-    product = Product.query.get(asin)
+    # Everything the page shows about the product, from one row
+    product = ProductSummary.get_or_refresh(asin)
+
+    if product is None:
+        abort(404)
+
+    # Only the newest page of reviews. The rest are fetched by the front end
+    # from /product-reviews/<asin>.json
+    reviews = product.get_recent_reviews()
+    next_cursor = None
+
+    if reviews and product.has_more_reviews():
+        next_cursor = encode_review_cursor(reviews[-1])
 
     favorite_reviews = None
     is_favorite = None
 
     if "user" in session:
         user_id = session["user"]["id"]
-        user = User.query.get(user_id)
+        favorite_ids = favorites_cache.get_favorite_ids(user_id)
 
-        # Return a set of their favorite reviews, and a boolean for whether
+        # A set of their favorite reviews, and a boolean for whether
         # they favorited the product on this page
-        favorite_reviews = user.get_favorite_review_ids()
-        is_favorite = user.is_favorite_product(asin)
+        favorite_reviews = favorite_ids.review_ids
+        is_favorite = asin in favorite_ids.asins
 
     return render_template("product_details.html",
                            product=product,
+                           reviews=reviews,
+                           next_cursor=next_cursor,
+                           chart_data=json.dumps(get_chart_data(product.get_scores())),
                            pos_words=json.dumps(product.pos_words),
                            neg_words=json.dumps(product.neg_words),
                            is_favorite=is_favorite,
                            favorite_reviews=favorite_reviews)
 
 
+@app.route('/product-reviews/<asin>.json')
+def product_reviews_page(asin):
+    """Return the next page of a product's reviews, newest first.
+
+       The before argument is the cursor returned with the previous page.
+    """
+
+    before = None
+
+    if request.args.get('before'):
+        before = decode_review_cursor(request.args.get('before'))
+
+        if before is None:
+            abort(400)
+
+    reviews, next_cursor = get_reviews_page(asin, before)
+
+    user_id = None
+
+    if "user" in session:
+        user_id = session["user"]["id"]
+
+    return jsonify({"reviews": format_reviews_to_dicts(reviews, user_id),
+                    "next": next_cursor})
+
+
+def get_reviews_page(asin, before=None):
+    """Return a (reviews, next page cursor) tuple for a product.
+
+       The cursor is None on the last page.
+    """
+
+    # Fetch one extra review to know if there's a next page
+    reviews = Product.get_reviews_page(asin, REVIEW_PAGE_SIZE + 1, before)
+
+    next_cursor = None
+
+    if len(reviews) > REVIEW_PAGE_SIZE:
+        reviews = reviews[:REVIEW_PAGE_SIZE]
+        next_cursor = encode_review_cursor(reviews[-1])
+
+    return (reviews, next_cursor)
+
+
 ##################### Favorites ################################
 
 @app.route('/user/<user_id>')
@@ -117,12 +307,18 @@ def display_user_profile(user_id):
     user_id = int(user_id)
     user = User.query.get(user_id)
 
+    if user is None:
+        abort(404)
+
+    # Two queries no matter how many favorites: one for the products and
+    # one for all of the favorite reviews
     favorite_products = user.favorite_products.all()
+    favorite_reviews = user.get_favorite_reviews_by_product()
 
     for pr in favorite_products:
 
         # Attach an attribute list to the product, with the user's favorited reviews
-        pr.favorited_reviews = user.get_favorite_reviews_for_product(pr.asin)
+        pr.favorited_reviews = favorite_reviews.get(pr.asin, [])
 
     return render_template("user_page.html",
                            user=user,
@@ -139,14 +335,10 @@ def favorite_product():
     asin = request.form.get('asin')
     user_id = session['user']['id']
 
-    user = User.query.get(user_id)
-
-    # Adds or removes a product from a user's favorites
-    favorite_status = user.update_favorite_product(asin)
-
-    # If the user unfavorites a product, remove all favorited reviews
-    if favorite_status == "Unfavorited":
-        user.remove_favorite_reviews(asin)
+    # Adds or removes a product from a user's favorites. Unfavoriting also
+    # removes the user's favorite reviews of the product.
+    favorite_status = User.toggle_favorite_product(user_id, asin)
+    favorites_cache.invalidate(user_id)
 
     return favorite_status
 
@@ -158,18 +350,16 @@ def favorite_review():
        Returns a message of whether the review was favorited or unfavorited
     """
 
-    review_id = request.form.get('reviewID')
-    asin = request.form.get('asin')
+    review_id = request.form.get('reviewID', type=int)
     user_id = session['user']['id']
 
-    user = User.query.get(user_id)
-
-    # Adds or removes a product from a user's favorites
-    favorite_status = user.update_favorite_review(review_id)
+    if review_id is None:
+        abort(400)
 
-    # If the user favorites a review, automatically favorite the product
-    if favorite_status == "Favorited":
-        user.add_favorite_product_from_review(asin)
+    # Adds or removes a review from a user's favorites. Favoriting a review
+    # also favorites its product.
+    favorite_status = User.toggle_favorite_review(user_id, review_id)
+    favorites_cache.invalidate(user_id)
 
     return favorite_status
 
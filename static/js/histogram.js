@@ -4,10 +4,10 @@ var options = { responsive: true };
 
 var ctx_bar = $("#barChart").get(0).getContext("2d");
 
-$.get("/product-scores/" + asin + ".json", function(data) {
-  var myBarChart = new Chart(ctx_bar, {
+// chartData is rendered into the page, so the chart needs no extra request
+var myBarChart = new Chart(ctx_bar, {
       type: 'bar',
-      data: data,
+      data: chartData,
       options: {
         legend: {
             display: false
@@ -27,5 +27,4 @@ $.get("/product-scores/" + asin + ".json", function(data) {
         } //scales
         
       } //options
-  });
 });
\ No newline at end of file
@@ -0,0 +1,31 @@
+// AJAX call to load the next page of a product's reviews, newest first
+
+"use strict";
+
+// Append a page of reviews and remember the cursor for the next one
+function displayMorePages(results) {
+
+    $("#reviews").append(reviewsToHtml(results.reviews));
+
+    // Must add event handler to new heart elements in DOM
+    $(".heart").off("click");
+    addHeartClicks();
+
+    if (results.next) {
+        $("#load-more-reviews").data("next", results.next).prop("disabled", false);
+    } else {
+        $("#load-more-reviews").remove();
+    }
+}
+
+function loadMoreProductReviews(evt) {
+    var button = $("#load-more-reviews");
+
+    button.prop("disabled", true);
+
+    $.get("/product-reviews/" + asin + ".json",
+        {"before": button.data("next")},
+        displayMorePages);
+}
+
+$("#load-more-reviews").on("click", loadMoreProductReviews);
@@ -2,9 +2,17 @@
 
 "use strict";
 
-// Replace existing html with new html that contains 
-// just reviews in user's search, with their query highlighted
-function displayReviews(results) {
+// State of the current review search. Results are fetched one page at a
+// time, and the next page is requested when the user scrolls to the bottom.
+var reviewSearch = {
+    query: null,
+    page: 1,
+    loading: false,
+    done: false
+};
+
+// Build the html for a list of reviews
+function reviewsToHtml(results) {
 
     var review_html = "";
 
@@ -26,26 +34,48 @@ function displayReviews(results) {
         review_html += "<p>" + obj.review + "</p><br><hr>";
     });
 
+    return review_html;
+}
+
+// Replace existing html with new html that contains
+// just reviews in user's search, with their query highlighted.
+// Pages after the first are appended to the existing results.
+function displayReviews(results) {
+
+    var review_html = reviewsToHtml(results.reviews);
+
     // Update the reviews html
-    $("#reviews").html(review_html);
+    if (reviewSearch.page === 1) {
+        $("#reviews").html(review_html);
+    } else {
+        $("#reviews").append(review_html);
+    }
+
+    // The server sends no next page after the last one
+    if (!results.next) {
+        reviewSearch.done = true;
+    }
+
+    reviewSearch.loading = false;
 
     // Extract the value of the query and format it
     // so that it can be highlighted in the review
-    var query = $("#query").val();
-    query = query.trim();
+    var query = reviewSearch.query.trim();
     var words = query.split(' ');
     $("#reviews").highlight(words);
 
     // Must add event handler to new heart elements in DOM
+    $(".heart").off("click");
     addHeartClicks();
 
 }
 
-function getReviewsFromSearch(evt) {
-    evt.preventDefault();
+function fetchReviewPage() {
+    reviewSearch.loading = true;
 
     var formInputs = {
-    "query": $("#query").val()
+    "query": reviewSearch.query,
+    "page": reviewSearch.page
     };
 
     $.get("/search-review/" + asin + ".json",
@@ -53,5 +83,31 @@ function getReviewsFromSearch(evt) {
         displayReviews);
 }
 
+function getReviewsFromSearch(evt) {
+    evt.preventDefault();
+
+    reviewSearch.query = $("#query").val();
+    reviewSearch.page = 1;
+    reviewSearch.done = false;
+
+    // Search results replace the product's reviews, so stop paging them
+    $("#load-more-reviews").hide();
+
+    fetchReviewPage();
+}
+
+// Load the next page of results when the user nears the bottom of the page
+function loadMoreReviews() {
+    if (reviewSearch.query === null || reviewSearch.loading || reviewSearch.done) {
+        return;
+    }
+
+    if ($(window).scrollTop() + $(window).height() > $(document).height() - 200) {
+        reviewSearch.page += 1;
+        fetchReviewPage();
+    }
+}
+
 // When user searches, make an AJAX call to retrieve matching reviews
 $("#review-search-form").on("submit", getReviewsFromSearch);
+$(window).on("scroll", loadMoreReviews);
@@ -1,8 +1,54 @@
 import unittest
+import json
+import tempfile
 
 from server import app
-from model import db, connect_to_db, example_data, User, Product, Review
-import json
+from model import db, connect_to_db, example_data, User, Product, Review, ProductSummary, Category
+from model import ProductWordCount
+from query_cache import QueryCache
+from search_query import normalize_query, InvalidQuery, make_search_filters
+import search_cache
+import favorites_cache
+from product_genius import encode_review_cursor, decode_review_cursor
+from keyword_extraction import extract_keywords
+from keyword_extraction import build_review_matrix, get_catalog_keywords
+from keyword_extraction import count_review_words, get_keywords_from_counts
+import keyword_stats
+from loader import parse_line, iter_batches, copy_value, parse_review_line
+from loader import load_reviews, load_products, get_category_paths, add_categories
+import indexes
+from evaluate_keywords import evaluate_product
+from nb_scorer import nb_keywords
+from sklearn.naive_bayes import MultinomialNB
+from sqlalchemy import event
+from contextlib import contextmanager
+from datetime import datetime
+from time import time
+import numpy as np
+
+# Seconds that counting categories for a broad search may take on the large
+# fixture in TestRoutePlans
+FACET_LATENCY_BUDGET = 0.5
+
+
+@contextmanager
+def count_queries():
+    """Count the sql statements sent to the db inside a with block.
+
+       Yields a list that gets one item per statement.
+    """
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
 
 
 ######################################################################
@@ -35,6 +81,18 @@ class ProductGeniusTests(unittest.TestCase):
         self.assertIn("Email", result.data)
         self.assertIn("Password", result.data)
 
+    def test_review_cursor(self):
+        """Test that review cursors round trip and reject garbage"""
+
+        review = Review(review="text", summary="summary", asin="A1", score=5,
+                        time=datetime(2014, 5, 3, 17, 45, 35))
+        review.review_id = 7
+
+        self.assertEqual(decode_review_cursor(encode_review_cursor(review)),
+                         (datetime(2014, 5, 3, 17, 45, 35), 7))
+        self.assertIsNone(decode_review_cursor("yesterday:7"))
+        self.assertIsNone(decode_review_cursor("2014-05-03T17:45:35:x"))
+
     def test_register_page(self):
         """Test that register page renders."""
 
@@ -45,6 +103,264 @@ class ProductGeniusTests(unittest.TestCase):
         self.assertIn("Password", result.data)
 
 
+class TestQueryCache(unittest.TestCase):
+    """Test the LRU + TTL cache used for search results."""
+
+    def setUp(self):
+        """Stuff to do before every test"""
+
+        self.now = 0
+        self.cache = QueryCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_hits_and_misses(self):
+        """Test that a cached value is only computed once"""
+
+        calls = []
+        compute = lambda: calls.append(1) or "result"
+
+        self.assertEqual(self.cache.get_or_compute("key", compute), "result")
+        self.assertEqual(self.cache.get_or_compute("key", compute), "result")
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted when full"""
+
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual(self.cache.get("a"), (True, 1))
+        self.assertEqual(self.cache.get("b"), (False, None))
+
+    def test_ttl_expiry(self):
+        """Test that entries expire after the ttl"""
+
+        self.cache.set("a", 1)
+        self.now = 11
+
+        self.assertEqual(self.cache.get("a"), (False, None))
+
+    def test_invalidate(self):
+        """Test invalidating matching entries"""
+
+        self.cache.set(("A1", "quality"), 1)
+        self.cache.set(("A2", "quality"), 2)
+        self.cache.invalidate(lambda key: key[0] == "A1")
+
+        self.assertEqual(self.cache.get(("A1", "quality")), (False, None))
+        self.assertEqual(self.cache.get(("A2", "quality")), (True, 2))
+
+
+class TestNormalizeQuery(unittest.TestCase):
+    """Test the canonical form of search queries."""
+
+    def test_equivalent_queries(self):
+        """Test that case, spacing, order and repeats don't matter"""
+
+        self.assertEqual(normalize_query("Black  Headphones"), "black headphones")
+        self.assertEqual(normalize_query(" headphones black BLACK "),
+                         "black headphones")
+
+    def test_punctuation(self):
+        """Test that tsquery syntax and punctuation are stripped"""
+
+        self.assertEqual(normalize_query("usb & (cable)!:*"), "cable usb")
+
+    def test_invalid_queries(self):
+        """Test that queries without terms are rejected"""
+
+        for query in [None, "", "   ", "&|!", "a" * 201]:
+            self.assertRaises(InvalidQuery, normalize_query, query)
+
+
+class TestLoadingHelpers(unittest.TestCase):
+    """Test the line parsing helpers of the seed file loaders."""
+
+    def test_parse_json_line(self):
+        """Test that strict json lines are parsed"""
+
+        self.assertEqual(parse_line('{"asin": "A1", "price": 9.99}'),
+                         {"asin": "A1", "price": 9.99})
+
+    def test_parse_python_literal_line(self):
+        """Test that lines that are python literals rather than json are parsed"""
+
+        line = "{'asin': 'A1', 'categories': [['Electronics', 'Headphones']]}"
+
+        self.assertEqual(parse_line(line),
+                         {"asin": "A1", "categories": [["Electronics", "Headphones"]]})
+
+    def test_parse_line_is_not_eval(self):
+        """Test that lines with code in them are rejected, not run"""
+
+        self.assertRaises(ValueError, parse_line, "__import__('os').getcwd()")
+
+    def test_iter_batches(self):
+        """Test that batches are full except for the last one"""
+
+        self.assertEqual(list(iter_batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(iter_batches(range(4), 2)), [[0, 1], [2, 3]])
+        self.assertEqual(list(iter_batches([], 2)), [])
+
+    def test_copy_value_escapes(self):
+        """Test that COPY's special characters are escaped"""
+
+        self.assertEqual(copy_value("tab\there"), u"tab\\there")
+        self.assertEqual(copy_value("line\nbreak"), u"line\\nbreak")
+        self.assertEqual(copy_value("carriage\rreturn"), u"carriage\\rreturn")
+        self.assertEqual(copy_value("back\\slash"), u"back\\\\slash")
+        self.assertEqual(copy_value(None), u"\\N")
+        self.assertEqual(copy_value(5), u"5")
+        self.assertEqual(copy_value(u"caf\xe9".encode("utf-8")), u"caf\xe9")
+
+    def test_copy_value_backslash_before_escapes(self):
+        """Test that a literal backslash-n isn't turned into a newline"""
+
+        self.assertEqual(copy_value("\\n"), u"\\\\n")
+
+    def test_parse_review_line(self):
+        """Test that a review line becomes one tab-separated COPY row"""
+
+        line = ("{'reviewText': 'Loud\\tand\\nclear &amp; cheap', 'asin': 'A1', "
+                "'overall': 5.0, 'summary': 'Nice', 'reviewTime': '02 12, 2016'}")
+
+        self.assertEqual(parse_review_line(line),
+                         "Loud\\tand\\nclear & cheap\tA1\t5\tNice\t2016-02-12T00:00:00")
+
+
+class TestKeywordExtraction(unittest.TestCase):
+    """Test keyword extraction on review text without the db."""
+
+    def test_extract_keywords(self):
+        """Test that positive and negative words come from the right reviews"""
+
+        reviews = [(5, "crisp sound and comfortable fit"),
+                   (4, "comfortable and crisp"),
+                   (1, "broke after a week, cheap plastic"),
+                   (2, "cheap plastic broke")]
+
+        asin, pos_words, neg_words = extract_keywords(("A1", "Black Headphones", reviews))
+
+        self.assertEqual(asin, "A1")
+        self.assertIn("comfortable", pos_words[:2])
+        self.assertIn("cheap", neg_words[:3])
+
+    def test_extract_keywords_one_class(self):
+        """Test that products without negative reviews get no keywords"""
+
+        reviews = [(5, "crisp sound"), (4, "comfortable fit")]
+
+        self.assertEqual(extract_keywords(("A1", "Headphones", reviews)),
+                         ("A1", [], []))
+
+    def test_keywords_from_counts_match_per_product(self):
+        """Test that keywords from stored word counts match a full refit"""
+
+        reviews = [(5, "crisp sound, comfortable headphones"),
+                   (4, "comfortable and light"),
+                   (1, "broke after a week, cheap plastic"),
+                   (2, "cheap plastic headphones")]
+
+        # Count the reviews in two installments, like incremental ingestion
+        counts = count_review_words([("A1", s, r) for s, r in reviews[:3]])
+
+        for key, (pos, neg) in count_review_words([("A1", s, r) for s, r in reviews[3:]]).items():
+            counts.setdefault(key, [0, 0])
+            counts[key][0] += pos
+            counts[key][1] += neg
+
+        word_counts = [(word, pos, neg) for (_, word), (pos, neg) in counts.items()]
+
+        self.assertEqual(get_keywords_from_counts(word_counts, "Black Headphones"),
+                         extract_keywords(("A1", "Black Headphones", reviews))[1:])
+
+    def test_evaluate_product(self):
+        """Test cross-validation of the keyword model on one product"""
+
+        reviews = ([(5, "crisp sound, comfortable fit")] * 6 +
+                   [(1, "cheap plastic broke")] * 6)
+
+        result = evaluate_product(("A1", "Headphones", reviews, 5, 0))
+
+        self.assertIsNone(result["error"])
+        self.assertEqual(result["precision"], 1.0)
+        self.assertEqual(result["recall"], 1.0)
+
+        # Too few negative reviews for 5 folds
+        result = evaluate_product(("A1", "Headphones", reviews[:8], 5, 0))
+
+        self.assertIsNotNone(result["error"])
+
+    def test_nb_keywords_match_sklearn(self):
+        """Test that the closed-form scorer ranks words like MultinomialNB"""
+
+        rng = np.random.RandomState(0)
+
+        # Small counts so that there are plenty of ties
+        counts = rng.randint(0, 4, size=(2, 200))
+        features = np.array(["w{:03d}".format(i) for i in range(200)])
+
+        nb = MultinomialNB()
+        nb.fit(counts, ["negative", "positive"])
+
+        pos_probs = nb.feature_log_prob_[1] - nb.feature_log_prob_[0]
+        neg_probs = nb.feature_log_prob_[0] - nb.feature_log_prob_[1]
+
+        expected = ([w for _, w in sorted(zip(pos_probs, features), reverse=True)[:10]],
+                    [w for _, w in sorted(zip(neg_probs, features), reverse=True)[:10]])
+
+        self.assertEqual(nb_keywords(counts[1], counts[0], features), expected)
+
+    def test_catalog_keywords_match_per_product(self):
+        """Test that the catalog-wide matrix gives the per-product keywords"""
+
+        titles = {"A1": "Black Headphones", "A2": "Monitor",
+                  "A3": "Cable", "A4": "Adapter"}
+        reviews = {"A3": [],
+                   "A4": [(3, "does the job")],
+                   "A1": [(5, "crisp sound, comfortable headphones"),
+                          (4, "comfortable and light"),
+                          (3, "okay sound"),
+                          (1, "broke after a week, cheap plastic"),
+                          (2, "cheap plastic headphones")],
+                   "A2": [(5, "bright monitor with sharp colors"),
+                          (1, "dead pixels and dim colors")]}
+
+        matrix = build_review_matrix([(asin, score, review)
+                                      for asin in sorted(reviews)
+                                      for score, review in reviews[asin]])
+
+        keywords = list(get_catalog_keywords(matrix, titles))
+
+        # Products without usable reviews get empty keywords, like per product
+        self.assertEqual(sorted(asin for asin, _, _ in keywords), sorted(titles))
+
+        for asin, pos_words, neg_words in keywords:
+            expected = extract_keywords((asin, titles[asin], reviews[asin]))
+            self.assertEqual((asin, pos_words, neg_words), expected)
+
+
+class TestIndexChecks(unittest.TestCase):
+    """Test the query plan check without a db"""
+
+    def test_find_seq_scans(self):
+        """Test that sequential scans are found anywhere in a plan"""
+
+        plan = {"Node Type": "Nested Loop",
+                "Plans": [{"Node Type": "Index Scan",
+                           "Relation Name": "products"},
+                          {"Node Type": "Seq Scan",
+                           "Relation Name": "reviews"},
+                          {"Node Type": "Seq Scan",
+                           "Relation Name": "categories"}]}
+
+        self.assertEqual(indexes.find_seq_scans(plan), ["reviews"])
+
+
 ######################################################################
 # Tests db instance methods. These test require database access,
 # but no additional setup for db objects.
@@ -72,6 +388,20 @@ class TestDBMethods(unittest.TestCase):
         db.session.close()
         db.drop_all()
 
+    def add_white_headphones(self, categories=()):
+        """Add a third, cheaper product that also matches 'headphones'"""
+
+        product3 = Product(asin='A3',
+                           title='White Headphones',
+                           description="White Headphones",
+                           price=80,
+                           image="www.headphones.com/white.jpg",
+                           categories=list(categories))
+        db.session.add(product3)
+        db.session.commit()
+
+        return product3
+
     def test_register_user(self):
         """Test that registering a new user works"""
 
@@ -95,6 +425,64 @@ class TestDBMethods(unittest.TestCase):
         self.assertEqual(scores1, [0, 1, 0, 0, 1])
         self.assertEqual(scores2, [0, 0, 1, 0, 0])
 
+    def test_recompute_scores(self):
+        """Test that Product.recompute_scores() matches the per-product methods"""
+
+        # Only rescore A2
+        Product.recompute_scores(["A2"])
+
+        self.assertIsNone(Product.query.get("A1").n_scores)
+        self.assertEqual(Product.query.get("A2").get_scores(), [0, 0, 1, 0, 0])
+
+        # Rescore everything
+        Product.recompute_scores()
+
+        product1 = Product.query.get("A1")
+
+        self.assertEqual(product1.get_scores(), [0, 1, 0, 0, 1])
+        self.assertEqual(product1.n_scores, 2)
+        self.assertAlmostEqual(product1.pg_score, 37.0/12)
+
+    def test_add_word_counts(self):
+        """Test that word counts are upserted in chunks and add up"""
+
+        batch_size = keyword_stats.WORD_COUNT_BATCH_SIZE
+        keyword_stats.WORD_COUNT_BATCH_SIZE = 2
+
+        try:
+            reviews = [("A1", 5, "loud clear bass"), ("A1", 1, "loud hiss")]
+
+            self.assertEqual(keyword_stats.add_word_counts(reviews), set(["A1"]))
+            keyword_stats.add_word_counts(reviews)
+        finally:
+            keyword_stats.WORD_COUNT_BATCH_SIZE = batch_size
+
+        loud = ProductWordCount.query.get(("A1", "loud"))
+        self.assertEqual((loud.pos_count, loud.neg_count), (2, 2))
+
+        self.assertEqual(ProductWordCount.query.count(), 4)
+
+    def test_fold_in_reviews(self):
+        """Test that new reviews update the stored counts and keywords"""
+
+        keyword_stats.rebuild_word_counts(refresh=True)
+
+        self.assertIn("sound", Product.query.get("A1").pos_words)
+
+        last_review_id = db.session.query(db.func.max(Review.review_id)).scalar()
+
+        db.session.add(Review(review='Cracked hinge after a month',
+                              asin='A1',
+                              score=1,
+                              summary="Cracked",
+                              time="2016-03-01 00:00:00"))
+        db.session.commit()
+
+        touched = keyword_stats.fold_in_reviews(last_review_id)
+
+        self.assertEqual(touched, set(["A1"]))
+        self.assertIn("hinge", Product.query.get("A1").neg_words)
+
     def test_find_products(self):
         """Test that full-text search works on products.
 
@@ -115,6 +503,173 @@ class TestDBMethods(unittest.TestCase):
         self.assertEqual(len(results2), 1)
         self.assertEqual(results2[0][0], "A2")
 
+    def test_find_products_pagination(self):
+        """Test that product search pages with a (relevancy, asin) cursor"""
+
+        self.add_white_headphones()
+
+        page1 = Product.find_products('headphones', page_size=1)
+
+        self.assertEqual(len(page1), 1)
+
+        cursor = (page1[0].relevancy, page1[0].asin)
+        page2 = Product.find_products('headphones', page_size=1, cursor=cursor)
+
+        self.assertEqual(len(page2), 1)
+        self.assertEqual(set([page1[0].asin, page2[0].asin]), set(["A1", "A3"]))
+
+        page3 = Product.find_products('headphones', page_size=1,
+                                      cursor=(page2[0].relevancy, page2[0].asin))
+
+        self.assertEqual(len(page3), 0)
+
+    def test_find_products_sort_and_filters(self):
+        """Test that product search sorts, filters and pages in the db"""
+
+        product3 = self.add_white_headphones([Category('Audio')])
+
+        by_price = Product.find_products('headphones', sort='price')
+        self.assertEqual([p.asin for p in by_price], ["A3", "A1"])
+
+        page1 = Product.find_products('headphones', page_size=1, sort='price')
+        page2 = Product.find_products('headphones', page_size=1, sort='price',
+                                      cursor=(page1[0].sort_key, page1[0].asin))
+        self.assertEqual([p.asin for p in page1 + page2], ["A3", "A1"])
+
+        cat_id = product3.categories[0].cat_id
+        in_category = Product.find_products('headphones',
+                                            filters=make_search_filters(cat_ids=[cat_id]))
+        self.assertEqual([p.asin for p in in_category], ["A3"])
+
+        expensive = Product.find_products('headphones',
+                                          filters=make_search_filters(min_price=90))
+        self.assertEqual([p.asin for p in expensive], ["A1"])
+
+    def test_count_categories(self):
+        """Test that search results are counted per category"""
+
+        audio = Category('Audio')
+        sale = Category('Sale')
+
+        self.add_white_headphones([audio, sale])
+        Product.query.get('A1').categories.append(audio)
+        db.session.commit()
+
+        counts = Product.count_categories('headphones')
+        self.assertEqual([(c.cat_name, c.n_products) for c in counts],
+                         [("Audio", 2), ("Sale", 1)])
+
+        # The category filter doesn't change the counts, the others do
+        filters = make_search_filters(cat_ids=[sale.cat_id])
+        self.assertEqual(len(Product.count_categories('headphones', filters)), 2)
+
+        filters = make_search_filters(max_price=90)
+        counts = Product.count_categories('headphones', filters)
+        self.assertEqual([(c.cat_name, c.n_products) for c in counts],
+                         [("Audio", 1), ("Sale", 1)])
+
+    def test_filter_conditions_alias(self):
+        """Test that filter conditions qualify columns with a table alias"""
+
+        params = {}
+        filters = make_search_filters(cat_ids=[1], min_price=10, min_n_scores=5)
+        conditions = Product.get_filter_conditions(filters, params, alias="p")
+
+        self.assertEqual(len(conditions), 3)
+        self.assertTrue(conditions[0].startswith("p.asin IN"))
+        self.assertEqual(conditions[1:], ["p.price >= :min_price",
+                                          "p.n_scores >= :min_n_scores"])
+        self.assertEqual(params, {'cat_ids': [1], 'min_price': 10, 'min_n_scores': 5})
+
+    def test_category_tree(self):
+        """Test that categories know their ancestors and best products"""
+
+        category_ids = get_category_paths()
+        add_categories(set([("Electronics",), ("Electronics", "Headphones")]),
+                       category_ids)
+
+        electronics = Category.query.get(category_ids[("Electronics",)])
+        headphones = Category.query.get(category_ids[("Electronics", "Headphones")])
+
+        self.assertEqual(headphones.parent_id, electronics.cat_id)
+        self.assertEqual(headphones.path,
+                         "{}.{}".format(electronics.cat_id, headphones.cat_id))
+
+        Product.query.get('A1').categories.extend([electronics, headphones])
+        Product.query.get('A2').categories.append(electronics)
+        db.session.commit()
+
+        self.assertEqual(headphones.get_ancestors(), [electronics])
+        self.assertEqual(electronics.children, [headphones])
+
+        # Rescoring refreshes the top products of each category
+        Product.recompute_scores()
+
+        electronics = Category.query.get(electronics.cat_id)
+        headphones = Category.query.get(headphones.cat_id)
+
+        # A1 has scores of 5 and 2, and A2 has a 3
+        self.assertEqual(electronics.top_asins, ["A1", "A2"])
+        self.assertEqual(headphones.top_asins, ["A1"])
+        self.assertEqual([p.asin for p in electronics.get_top_products()], ["A1", "A2"])
+
+    def test_category_path_trigger(self):
+        """Test that categories created through the ORM get a path"""
+
+        electronics = Category('Electronics')
+        db.session.add(electronics)
+        db.session.commit()
+
+        cables = Category('Cables', parent_id=electronics.cat_id)
+        db.session.add(cables)
+        db.session.commit()
+
+        self.assertEqual(electronics.path, str(electronics.cat_id))
+        self.assertEqual(cables.path, "{}.{}".format(electronics.cat_id, cables.cat_id))
+        self.assertEqual(cables.get_ancestors(), [electronics])
+
+    def test_load_products_category_tree(self):
+        """Test that loading products builds the tree from their category paths,
+           and that loading the same file again doesn't fail
+        """
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("{'asin': 'B1', 'title': 'Earbuds', 'price': 20.0, 'imUrl': 'b1.jpg', "
+                    "'categories': [['Electronics', 'Accessories', 'Headphones']]}\n"
+                    "{'asin': 'B2', 'title': 'Cable', 'price': 5.0, 'imUrl': 'b2.jpg', "
+                    "'categories': [['Electronics', 'Accessories']]}\n")
+            f.flush()
+
+            load_products(f.name)
+            load_products(f.name)
+
+        category_ids = get_category_paths()
+        root = category_ids[("Electronics",)]
+        accessories = category_ids[("Electronics", "Accessories")]
+        headphones = category_ids[("Electronics", "Accessories", "Headphones")]
+
+        self.assertEqual(len(category_ids), 3)
+        self.assertIsNone(Category.query.get(root).parent_id)
+        self.assertEqual(Category.query.get(accessories).parent_id, root)
+        self.assertEqual(Category.query.get(headphones).parent_id, accessories)
+        self.assertEqual(Category.query.get(headphones).path,
+                         "{}.{}.{}".format(root, accessories, headphones))
+
+        # Products are linked at every level of their path
+        self.assertEqual(sorted(c.cat_id for c in Product.query.get('B1').categories),
+                         sorted([root, accessories, headphones]))
+        self.assertEqual(sorted(c.cat_id for c in Product.query.get('B2').categories),
+                         sorted([root, accessories]))
+
+    def test_search_vectors_deferred(self):
+        """Test that loading products and reviews leaves out their search vectors"""
+
+        product = Product.query.get('A1')
+        review = Review.query.get(1)
+
+        self.assertNotIn('search_vector', product.__dict__)
+        self.assertNotIn('search_vector', review.__dict__)
+
     def test_find_reviews(self):
         """Test that full-text search works on reviews.
 
@@ -135,6 +690,181 @@ class TestDBMethods(unittest.TestCase):
         self.assertEqual(len(results2), 1)
         self.assertIn("monitor broke", results2[0][1])
 
+    def test_find_reviews_limit_offset(self):
+        """Test that review search only returns the requested page"""
+
+        # Both of A1's reviews mention quality
+        page1 = Review.find_reviews('A1', 'quality', limit=1)
+        page2 = Review.find_reviews('A1', 'quality', limit=1, offset=1)
+
+        self.assertEqual(len(page1), 1)
+        self.assertEqual(len(page2), 1)
+        self.assertNotEqual(page1[0].review_id, page2[0].review_id)
+
+    def test_product_summary_refresh(self):
+        """Test that summaries are built from the product and its newest reviews"""
+
+        self.assertIsNone(ProductSummary.query.get('A1'))
+
+        summary = ProductSummary.get_or_refresh('A1')
+
+        self.assertEqual(summary.title, "Black Headphones")
+        self.assertEqual(summary.recent_review_ids, [1, 2])
+        self.assertEqual([r.review_id for r in summary.get_recent_reviews()], [1, 2])
+
+        self.assertIsNone(ProductSummary.get_or_refresh('nonexistent'))
+
+    def test_product_summary_more_reviews(self):
+        """Test that summaries know whether reviews go past the first page"""
+
+        page_size = ProductSummary.N_RECENT_REVIEWS
+        ProductSummary.N_RECENT_REVIEWS = 1
+
+        try:
+            ProductSummary.refresh()
+
+            summary1 = ProductSummary.query.get('A1')
+            summary2 = ProductSummary.query.get('A2')
+
+            self.assertEqual([r.review_id for r in summary1.get_recent_reviews()], [1])
+            self.assertTrue(summary1.has_more_reviews())
+            self.assertEqual([r.review_id for r in summary2.get_recent_reviews()], [3])
+            self.assertFalse(summary2.has_more_reviews())
+        finally:
+            ProductSummary.N_RECENT_REVIEWS = page_size
+
+    def test_load_reviews_refreshes_summaries(self):
+        """Test that loading reviews rescores their products and summaries"""
+
+        ProductSummary.refresh()
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("{'reviewText': 'Bright and sharp', 'asin': 'A2', 'overall': 5.0, "
+                    "'summary': 'Great monitor', 'reviewTime': '01 05, 2017'}\n")
+            f.flush()
+
+            load_reviews(f.name, n_workers=1)
+
+        summary = ProductSummary.query.get('A2')
+
+        self.assertEqual(summary.n_scores, 2)
+        self.assertEqual(summary.get_scores(), [0, 0, 1, 0, 1])
+        self.assertEqual(summary.recent_review_ids, [4, 3])
+
+    def test_recompute_scores_refreshes_summary(self):
+        """Test that rescoring a product updates its summary"""
+
+        ProductSummary.refresh()
+        Product.recompute_scores(['A1'])
+
+        summary = ProductSummary.query.get('A1')
+
+        self.assertEqual(summary.get_scores(), [0, 1, 0, 0, 1])
+        self.assertEqual(summary.n_scores, 2)
+
+    def test_mean_product_score_without_scores(self):
+        """Test that the mean is None before any product is scored"""
+
+        Product.invalidate_mean_product_score()
+
+        self.assertIsNone(Product.get_mean_product_score())
+        Product.invalidate_mean_product_score()
+
+    def test_get_reviews_page(self):
+        """Test that product reviews are paged newest first by keyset"""
+
+        page1 = Product.get_reviews_page('A1', 1)
+        self.assertEqual([r.review_id for r in page1], [1])
+
+        page2 = Product.get_reviews_page('A1', 1, (page1[-1].time, page1[-1].review_id))
+        self.assertEqual([r.review_id for r in page2], [2])
+
+        page3 = Product.get_reviews_page('A1', 1, (page2[-1].time, page2[-1].review_id))
+        self.assertEqual(page3, [])
+
+
+class TestRoutePlans(unittest.TestCase):
+    """Test that the main route queries use indexes on a large catalog"""
+
+    def setUp(self):
+        """Fill the db with enough rows that the planner prefers indexes"""
+
+        connect_to_db(app, "postgresql:///testdb")
+        db.create_all()
+
+        db.session.execute("""
+            INSERT INTO users (name, email, password)
+            SELECT 'user' || i, 'user' || i || '@user.com', 'abc'
+            FROM generate_series(1, 1000) i;
+
+            INSERT INTO products (asin, title, description, price, image,
+                                  scores, n_scores, pg_score, pos_words, neg_words)
+            SELECT 'P' || i, 'Widget model' || i, 'A widget', 10, 'www.widgets.com',
+                   '{1,1,1,1,1}', 5, random() * 5, '[]', '[]'
+            FROM generate_series(1, 5000) i;
+
+            INSERT INTO categories (cat_name)
+            SELECT 'Category ' || i
+            FROM generate_series(1, 100) i;
+
+            INSERT INTO product_categories (asin, cat_id)
+            SELECT 'P' || i, 1 + (i + k) % 100
+            FROM generate_series(1, 5000) i, generate_series(1, 3) k;
+
+            INSERT INTO reviews (review, asin, score, summary, time)
+            SELECT 'Review ' || j || ' of model' || i, 'P' || i, 1 + j % 5,
+                   'Summary', timestamp '2015-01-01' + j * interval '1 day'
+            FROM generate_series(1, 5000) i, generate_series(1, 20) j;
+
+            INSERT INTO favorite_products (user_id, asin)
+            SELECT u, 'P' || ((u * 25 + k) % 5000 + 1)
+            FROM generate_series(1, 1000) u, generate_series(1, 50) k;
+
+            INSERT INTO favorite_reviews (user_id, review_id)
+            SELECT u, (u * 97 + k * 13) % 100000 + 1
+            FROM generate_series(1, 1000) u, generate_series(1, 50) k;
+        """)
+        db.session.commit()
+
+        ProductSummary.refresh()
+        Category.refresh_top_products()
+
+        db.session.execute("ANALYZE;")
+        db.session.commit()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def test_category_counts_latency(self):
+        """Test that counting categories for a search matching every product
+           stays within its latency budget
+        """
+
+        start_time = time()
+        counts = Product.count_categories('widget')
+        elapsed = time() - start_time
+
+        self.assertEqual(sum(c.n_products for c in counts), 20 * 150)
+        self.assertLess(elapsed, FACET_LATENCY_BUDGET)
+
+    def test_route_queries_use_indexes(self):
+        """Test that no route query reads a large table sequentially"""
+
+        self.assertEqual(indexes.check_route_queries(), {})
+
+    def test_route_queries_cover_pages(self):
+        """Test that the check includes the product and category page queries"""
+
+        names = [name for name, sql, params
+                 in indexes.route_queries(indexes.sample_params())]
+
+        for name in ("product summary", "product page reviews",
+                     "more product reviews", "category top products"):
+            self.assertIn(name, names)
+
 
 ######################################################################
 # Tests related to Product-Genius Scores. These require access to the
@@ -164,7 +894,7 @@ class TestPGScores(unittest.TestCase):
 
         for p in products:
             scores = p.calculate_score_distribution()
-            p.scores = json.dumps(scores)
+            p.scores = scores
             p.n_scores = sum(scores)
 
             db.session.commit()
@@ -199,6 +929,37 @@ class TestPGScores(unittest.TestCase):
         self.assertEqual(pg1, 37.0/12)
         self.assertEqual(pg2, 3.0)
 
+    def test_get_mean_product_score(self):
+        """Test that Product.get_mean_product_score() returns stars/scores"""
+
+        # The scores were set directly in setUp, so drop any cached mean
+        Product.invalidate_mean_product_score()
+
+        self.assertAlmostEqual(Product.get_mean_product_score(), 10.0/3)
+
+    def test_mean_product_score_expires(self):
+        """Test that a cached mean is re-read from the db after its ttl"""
+
+        now = [0]
+        cache = Product._mean_score_cache
+        Product._mean_score_cache = QueryCache(max_size=1, ttl=300, clock=lambda: now[0])
+
+        try:
+            self.assertAlmostEqual(Product.get_mean_product_score(), 10.0/3)
+
+            # Another process rescores: this one doesn't get invalidated
+            db.session.execute("UPDATE products SET scores = '{0,0,0,0,1}', n_scores = 1 "
+                               "WHERE asin = 'A2';")
+            db.session.commit()
+
+            now[0] = 299
+            self.assertAlmostEqual(Product.get_mean_product_score(), 10.0/3)
+
+            now[0] = 301
+            self.assertAlmostEqual(Product.get_mean_product_score(), 12.0/3)
+        finally:
+            Product._mean_score_cache = cache
+
 
 ######################################################################
 # Tests for favoriting products and reviews. These tests require
@@ -248,6 +1009,14 @@ class TestFavoriting(unittest.TestCase):
         self.assertEqual(len(fav_reviews), 1)
         self.assertIsInstance(fav_reviews, set)
 
+    def test_fetch_favorite_ids(self):
+        """Test that User.fetch_favorite_ids() returns both sets of ids"""
+
+        asins, review_ids = User.fetch_favorite_ids(1)
+
+        self.assertEqual(asins, {"A1"})
+        self.assertEqual(review_ids, {1})
+
     def test_is_favorite_product(self):
         """Test that User.is_favorite_product() works"""
 
@@ -284,6 +1053,29 @@ class TestFavoriting(unittest.TestCase):
         self.assertFalse(user.is_favorite_review(1))
         self.assertTrue(user.is_favorite_review(2))
 
+    def test_toggle_favorite_product_removes_reviews(self):
+        """Test that unfavoriting a product also unfavorites its reviews"""
+
+        self.assertEqual(User.toggle_favorite_product(1, "A1"), "Unfavorited")
+
+        user = User.query.get(1)
+        self.assertFalse(user.is_favorite_product("A1"))
+        self.assertFalse(user.is_favorite_review(1))
+
+        self.assertEqual(User.toggle_favorite_product(1, "A1"), "Favorited")
+
+    def test_toggle_favorite_review_adds_product(self):
+        """Test that favoriting a review also favorites its product"""
+
+        self.assertEqual(User.toggle_favorite_review(1, 3), "Favorited")
+
+        user = User.query.get(1)
+        self.assertTrue(user.is_favorite_review(3))
+        self.assertTrue(user.is_favorite_product("A2"))
+
+        self.assertEqual(User.toggle_favorite_review(1, 3), "Unfavorited")
+        self.assertTrue(user.is_favorite_product("A2"))
+
     def test_add_favorite_product_from_review(self):
         """Test that User.add_favorite_product_from_review() works"""
 
@@ -333,7 +1125,7 @@ class FlaskTestNoUser(unittest.TestCase):
 
         p = Product.query.get("A1")
         scores = p.calculate_score_distribution()
-        p.scores = json.dumps(scores)
+        p.scores = scores
         p.n_scores = sum(scores)
         p.pg_score = p.calculate_pg_score()
         p.pos_words = []
@@ -347,6 +1139,11 @@ class FlaskTestNoUser(unittest.TestCase):
         db.session.close()
         db.drop_all()
 
+        # Don't let cached searches leak between tests
+        search_cache.invalidate_products()
+        search_cache.invalidate_reviews()
+        favorites_cache.favorites_cache.invalidate()
+
     def test_product_listing_page(self):
         """Test that a product listing page loads"""
 
@@ -356,6 +1153,35 @@ class FlaskTestNoUser(unittest.TestCase):
         self.assertIn("You searched for \"headphones\"", result.data)
         self.assertIn("Black Headphones", result.data)
 
+    def test_product_listing_sort(self):
+        """Test that the listing takes a sort and rejects unknown ones"""
+
+        result = self.client.get("/search?query=headphones&sort=pg_score&min_reviews=1")
+        self.assertIn("Black Headphones", result.data)
+
+        result = self.client.get("/search?query=headphones&min_reviews=3")
+        self.assertNotIn("Black Headphones", result.data)
+
+        result = self.client.get("/search?query=headphones&sort=title")
+        self.assertEqual(result.status_code, 400)
+
+    def test_browse_category(self):
+        """Test that a category page lists its best products"""
+
+        category = Category('Audio')
+        Product.query.get('A1').categories.append(category)
+        db.session.commit()
+
+        Category.refresh_top_products()
+        ProductSummary.refresh()
+
+        result = self.client.get("/category/{}".format(category.cat_id))
+
+        self.assertIn("Best products in Audio", result.data)
+        self.assertIn("Black Headphones", result.data)
+
+        self.assertEqual(self.client.get("/category/999999").status_code, 404)
+
     def test_product_details_page(self):
         """Test that a product details page loads"""
 
@@ -371,6 +1197,78 @@ class FlaskTestNoUser(unittest.TestCase):
         self.assertIn("These headphones had excellent sound quality", result.data)
         self.assertIn("Terrible waste of money", result.data)
 
+    def test_product_details_after_reload(self):
+        """Test that reloading a product's metadata updates its page"""
+
+        self.client.get("/product/A1")
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("{'asin': 'A1', 'title': 'Black Headphones', 'price': 150.0, "
+                    "'imUrl': 'www.headphones.com/black.jpg', "
+                    "'categories': [['Electronics']]}\n")
+            f.flush()
+
+            load_products(f.name)
+
+        result = self.client.get("/product/A1")
+
+        self.assertIn("Price: $150.0", result.data)
+
+    def test_product_reviews_newest_first(self):
+        """Test that the product page lists the newest reviews first"""
+
+        result = self.client.get("/product/A1")
+
+        self.assertLess(result.data.index("These headphones had excellent sound quality"),
+                        result.data.index("Terrible waste of money"))
+        self.assertNotIn("id=\"load-more-reviews\"", result.data)
+
+    def test_product_reviews_json(self):
+        """Test that the next page of reviews comes from the json route"""
+
+        result = self.client.get("/product-reviews/A1.json?before=2016-02-12T00:00:00:1")
+        data = json.loads(result.data)
+
+        self.assertEqual([r["review_id"] for r in data["reviews"]], [2])
+        self.assertIsNone(data["next"])
+
+        result = self.client.get("/product-reviews/A1.json?before=nonsense")
+        self.assertEqual(result.status_code, 400)
+
+    def test_product_scores_etag(self):
+        """Test that the histogram data is embedded and revalidated with etags"""
+
+        result = self.client.get("/product/A1")
+        self.assertIn("var chartData = ", result.data)
+
+        result = self.client.get("/product-scores/A1.json")
+        etag = result.headers["ETag"]
+
+        self.assertEqual(etag, '"2-0-1-0-0-1"')
+        self.assertIn("max-age", result.headers["Cache-Control"])
+
+        result = self.client.get("/product-scores/A1.json",
+                                 headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+
+    def test_product_page_query_count(self):
+        """Test that a product page is a summary lookup plus its reviews"""
+
+        self.client.get("/product/A1")
+        db.session.expunge_all()
+
+        with count_queries() as statements:
+            result = self.client.get("/product/A1")
+
+        self.assertIn("Black Headphones", result.data)
+        self.assertLessEqual(len(statements), 2)
+
+    def test_missing_product(self):
+        """Test that unknown products 404 on the page and the scores route"""
+
+        self.assertEqual(self.client.get("/product/nonexistent").status_code, 404)
+        self.assertEqual(self.client.get("/product-scores/nonexistent.json").status_code, 404)
+
     def test_register_user(self):
         """Test that registration post route works"""
 
@@ -435,7 +1333,7 @@ class FlaskTestUser(unittest.TestCase):
         # Set up product object
         p = Product.query.get("A1")
         scores = p.calculate_score_distribution()
-        p.scores = json.dumps(scores)
+        p.scores = scores
         p.n_scores = sum(scores)
         p.pg_score = p.calculate_pg_score()
         p.pos_words = []
@@ -464,6 +1362,11 @@ class FlaskTestUser(unittest.TestCase):
         db.session.close()
         db.drop_all()
 
+        # Don't let cached searches leak between tests
+        search_cache.invalidate_products()
+        search_cache.invalidate_reviews()
+        favorites_cache.favorites_cache.invalidate()
+
     def test_user_page(self):
         """Test that a user's page loads"""
 
@@ -477,6 +1380,38 @@ class FlaskTestUser(unittest.TestCase):
         # Test user's favorite reviews display
         self.assertIn("Great Headphones", result.data)
 
+    def test_user_page_query_count(self):
+        """Test that the user page doesn't make a query per favorite product"""
+
+        user = User.query.get(1)
+
+        for i in range(20):
+            product = Product(asin='F{}'.format(i),
+                              title='Favorite {}'.format(i),
+                              description="Favorite product",
+                              price=10,
+                              image="www.favorites.com/{}.jpg".format(i),
+                              categories=[])
+            review = Review(review='Favorite review {}'.format(i),
+                            asin=product.asin,
+                            score=4,
+                            summary="Summary {}".format(i),
+                            time="2016-02-12 00:00:00")
+            db.session.add_all([product, review])
+            user.favorite_products.append(product)
+            user.favorite_reviews.append(review)
+
+        db.session.commit()
+        db.session.expunge_all()
+
+        with count_queries() as statements:
+            result = self.client.get("/user/1")
+
+        self.assertIn("Summary 19", result.data)
+
+        # The user, their favorite products and their favorite reviews
+        self.assertLessEqual(len(statements), 3)
+
     def test_hearts_with_user(self):
         """Test that hearts and favorite button appear when user is logged in"""
 
@@ -485,6 +1420,21 @@ class FlaskTestUser(unittest.TestCase):
         self.assertIn("class=\"heart\"", result.data)
         self.assertIn("id=\"product-fav-button\"", result.data)
 
+    def test_product_page_favorites_cached(self):
+        """Test that favorites are fetched once and refreshed after a toggle"""
+
+        self.client.get("/product/A2")
+
+        with count_queries() as statements:
+            self.client.get("/product/A2")
+
+        self.assertFalse([s for s in statements if "favorite" in s])
+
+        self.client.post('favorite-product', data={"asin": "A2"})
+        result = self.client.get("/product/A2")
+
+        self.assertIn("id=\"product-fav-button\">Favorited</button>", result.data)
+
     def test_navbar_with_user(self):
         """Test that navbar shows logout, user while user logged in."""
 
@@ -503,6 +1453,16 @@ class FlaskTestUser(unittest.TestCase):
         # Test that reviews not matching query are not in output
         self.assertNotIn("Great Headphones", result.data)
 
+    def test_search_in_reviews_pages(self):
+        """Test that review search returns a page of reviews and the next page"""
+
+        result = self.client.get('/search-review/A1.json?query=quality')
+        data = json.loads(result.data)
+
+        # Both of A1's reviews fit on the first page
+        self.assertEqual(len(data["reviews"]), 2)
+        self.assertIsNone(data["next"])
+
     def test_favoriting_product(self):
         """Test that favoriting a product updates the db"""
 